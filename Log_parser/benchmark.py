@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import re
+import json
+import gzip
+import time
+import random
+import shutil
+import tempfile
+import datetime
+import platform
+import argparse
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# log_analyzer parses the command line on import
+_argv, sys.argv = sys.argv, sys.argv[:1]
+import log_analyzer as la
+sys.argv = _argv
+
+LOG_LINE = ('{ip} -  - [{date:%d/%b/%Y:%H:%M:%S} +0300] "GET {url} HTTP/1.1" 200 {size} "-" '
+            '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+            '"dc7161be3" {time:.3f}\n')
+
+URL_TEMPLATES = ('/api/v2/banner/{}',
+                 '/api/v2/group/{}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+                 '/api/v2/internal/banner/{}/info',
+                 '/api/1/photogenic_banners/list/?server_name=WIN7RB{}',
+                 '/export/appinstall_raw/2017-06-{}/')
+
+STAGES = ('find_log', 'parser_log', 'aggregate_stat', 'create_report')
+
+GENERATE_BATCH = 100000
+
+
+def generate_log(file_dir, lines, urls=1000, skew=1.0, seed=1, bad_ratio=0.0):
+    """Write deterministic nginx ui_short log, gzip compressed if file name ends with .gz.
+        Return number of written lines.
+
+        Keyword arguments:
+        file_dir -- path of the log file
+        lines -- number of requests
+        urls -- number of distinct urls
+        skew -- exponent of Zipf distribution of url popularity, 0 is uniform
+        seed -- seed of random generator, equal arguments give equal files
+        bad_ratio -- share of unparsable lines
+        """
+    rnd = random.Random(seed)
+    url_list = [URL_TEMPLATES[i % len(URL_TEMPLATES)].format(i) for i in range(urls)]
+    base_times = [rnd.uniform(0.01, 1.0) for _ in range(urls)]
+    cum_weights = []
+    total = 0
+    for rank in range(urls):
+        total += 1 / (rank + 1) ** skew
+        cum_weights.append(total)
+    start = datetime.datetime(2017, 6, 29, 3, 50, 22)
+
+    f = gzip.open(file_dir, 'wt', encoding='utf-8') if file_dir.endswith('.gz') else \
+        open(file_dir, 'w', encoding='utf-8')
+    with f:
+        written = 0
+        while written < lines:
+            batch = min(GENERATE_BATCH, lines - written)
+            ids = rnd.choices(range(urls), cum_weights=cum_weights, k=batch)
+            content = []
+            for url_id in ids:
+                if bad_ratio and rnd.random() < bad_ratio:
+                    content.append('broken line\n')
+                    continue
+                content.append(LOG_LINE.format(
+                    ip=f'1.{url_id % 256}.116.{written % 256}',
+                    date=start + datetime.timedelta(seconds=written // 100),
+                    url=url_list[url_id],
+                    size=rnd.randrange(100, 100000),
+                    time=base_times[url_id] * rnd.lognormvariate(0, 0.5)))
+                written += 1
+            f.writelines(content)
+    return written
+
+
+def reset_peak_rss():
+    """Reset peak resident set size of the process, Linux only"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return peak resident set size of the process in KB"""
+    try:
+        with open('/proc/self/status') as f:
+            return int(re.search(r'VmHWM:\s+(\d+)', f.read()).group(1))
+    except (OSError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+def measure(func, lines=None):
+    """Call func and return its result and metrics: wall and cpu time, lines/sec and peak RSS"""
+    reset_peak_rss()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    result = func()
+    wall_time, cpu_time = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    if callable(lines):
+        lines = lines(result)
+    return result, {'wall_time': round(wall_time, 4), 'cpu_time': round(cpu_time, 4), 'lines': lines,
+                    'lines_per_sec': round(lines / wall_time) if lines and wall_time else None,
+                    'peak_rss_kb': peak_rss()}
+
+
+def run_pipeline(log_dir, config):
+    """Run stages of log_analyzer pipeline on the newest log of log_dir, return metrics of every stage
+
+        Keyword arguments:
+        log_dir -- directory of the log
+        config -- configuration parameters (dict), see log_analyzer.config
+        """
+    file_path, find_metrics = measure(lambda: la.find_log(log_dir))
+    url_rules = la.parse_url_rules(config.get('url_rules'))
+    rel_error = la.get_rel_error(config.get('aggregate_mode'), config.get('quantile_error'))
+    # parsed pairs are kept in memory so that aggregate_stat is measured alone
+    pairs, parse_metrics = measure(
+        lambda: list(la.parser_log(file_path, log_dir, config.get('err_lines'), config.get('gz_reader'),
+                                   int(config.get('gz_threads')), config.get('line_parser'), url_rules)), len)
+    rows, aggregate_metrics = measure(
+        lambda: la.aggregate_stat(file_path, iter(pairs), config.get('aggregate_mode'), rel_error,
+                                  int(config.get('report_size')), config.get('backend')), lambda rows: len(pairs))
+    del pairs
+    _, report_metrics = measure(lambda: la.create_report(config, file_path.date, rows))
+    return dict(zip(STAGES, (find_metrics, parse_metrics, aggregate_metrics, report_metrics)))
+
+
+def best_run(runs):
+    """Return metrics of every stage with minimal wall time among runs"""
+    return {stage: min((run[stage] for run in runs), key=lambda metrics: metrics['wall_time'])
+            for stage in STAGES}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    """Return lines of text comparing wall time of stages with baseline results"""
+    lines = [f'baseline {baseline.get("commit")}, current {results.get("commit")}']
+    for fmt, run in results['runs'].items():
+        for stage, metrics in run['stages'].items():
+            old = baseline.get('runs', {}).get(fmt, {}).get('stages', {}).get(stage)
+            if not old or not old['wall_time']:
+                continue
+            lines.append(f'{fmt:5} {stage:15} {old["wall_time"]:9.4f}s -> {metrics["wall_time"]:9.4f}s '
+                         f'({metrics["wall_time"] / old["wall_time"] - 1:+.1%})')
+    return lines
+
+
+def main():
+    parser_args = argparse.ArgumentParser(description='Benchmark of log_analyzer stages on generated logs')
+    parser_args.add_argument('-n', '--lines', type=int, default=1000000)
+    parser_args.add_argument('-u', '--urls', type=int, default=50000)
+    parser_args.add_argument('--skew', type=float, default=1.0, help='Zipf exponent of url popularity')
+    parser_args.add_argument('--seed', type=int, default=1)
+    parser_args.add_argument('--bad-ratio', type=float, default=0.0001, help='share of unparsable lines')
+    parser_args.add_argument('--formats', nargs='+', choices=('log', 'gz'), default=['log', 'gz'])
+    parser_args.add_argument('-r', '--repeat', type=int, default=1, help='the best of several runs is stored')
+    parser_args.add_argument('-s', '--set', action='append', default=[], metavar='KEY=VALUE',
+                             help='override setting of log_analyzer config')
+    parser_args.add_argument('-d', '--dir', help='directory of generated logs, kept between runs')
+    parser_args.add_argument('-o', '--output', default='benchmark.json')
+    parser_args.add_argument('--compare', help='results of previous run to compare with')
+    args = parser_args.parse_args()
+
+    config = {k.lower(): v for k, v in la.config.items()}
+    config['err_lines'] = 20
+    config.update(item.split('=', 1) for item in args.set)
+
+    work_dir = args.dir or tempfile.mkdtemp(prefix='log_analyzer_bench_')
+    template_dir = tempfile.mkdtemp(prefix='log_analyzer_report_')
+    config['report_dir'] = template_dir
+    # create_report reads the template from the current directory
+    with open(os.path.join(template_dir, 'report.html'), 'w') as f:
+        f.write('<html><body><script>var table = $table_json;</script></body></html>')
+    cwd = os.getcwd()
+
+    results = {'commit': git_commit(), 'python': platform.python_version(),
+               'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+               'params': {'lines': args.lines, 'urls': args.urls, 'skew': args.skew, 'seed': args.seed,
+                          'bad_ratio': args.bad_ratio},
+               'settings': {k: config[k] for k in ('aggregate_mode', 'quantile_error', 'gz_reader', 'gz_threads',
+                                                   'line_parser', 'backend', 'url_rules',
+                                                   'report_size')},
+               'runs': {}}
+    try:
+        for fmt in args.formats:
+            log_dir = os.path.join(work_dir, f'{args.lines}-{args.urls}-{args.skew}-{args.seed}-{fmt}')
+            file_name = f'nginx-access-ui-20170630.{fmt}'
+            file_dir = os.path.join(log_dir, file_name)
+            if not os.path.exists(file_dir):
+                os.makedirs(log_dir, exist_ok=True)
+                tmp_dir = os.path.join(log_dir, 'tmp-' + file_name)
+                generate_log(tmp_dir, args.lines, args.urls, args.skew, args.seed, args.bad_ratio)
+                os.replace(tmp_dir, file_dir)
+            os.chdir(template_dir)
+            try:
+                runs = [run_pipeline(log_dir, config) for _ in range(args.repeat)]
+            finally:
+                os.chdir(cwd)
+            results['runs'][fmt] = {'file_size': os.path.getsize(file_dir), 'stages': best_run(runs)}
+    finally:
+        shutil.rmtree(template_dir)
+        if not args.dir:
+            shutil.rmtree(work_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for fmt, run in results['runs'].items():
+        for stage, metrics in run['stages'].items():
+            print(f'{fmt:5} {stage:15} {metrics["wall_time"]:9.4f}s cpu {metrics["cpu_time"]:9.4f}s '
+                  f'{metrics["lines_per_sec"] or "-":>10} lines/s  peak rss {metrics["peak_rss_kb"]} KB')
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(results, json.load(f))))
+
+
+if __name__ == '__main__':
+    main()
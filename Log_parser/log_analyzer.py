@@ -4,17 +4,38 @@
 import os
 import sys
 import json
+import math
+import heapq
 import statistics
 from string import Template
-from collections import namedtuple, defaultdict
+from collections import namedtuple
 import datetime
 import time
 import re
 import gzip
+import zlib
+import queue
+import struct
+import threading
+from collections import deque
 import argparse
 import configparser
 import logging
+import marshal
+import csv
+import sqlite3
+import inspect
+import reprlib
+import operator
+import cProfile
+from array import array
 from functools import wraps
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
@@ -24,6 +45,23 @@ from functools import wraps
 parser_args = argparse.ArgumentParser()
 parser_args.add_argument('-c', '--config', default='config.ini')
 parser_args.add_argument('-l', '--level', default='i')
+parser_args.add_argument('-w', '--workers', type=int, default=1)
+parser_args.add_argument('--rebuild', action='store_true',
+                         help='reparse the log ignoring the aggregate cache and overwrite the report')
+parser_args.add_argument('--force', action='store_true',
+                         help='overwrite the existing report, the aggregate is loaded from cache when possible')
+parser_args.add_argument('-b', '--batch', action='store_true',
+                         help='generate reports for all logs without report, batch_workers files at a time')
+parser_args.add_argument('-f', '--follow', nargs='?', const='', default=None,
+                         help='tail the active log (follow_file by default) and update the report periodically')
+parser_args.add_argument('-q', '--query', choices=('trend', 'regressions'),
+                         help='print trend or regressions of url request time over --days days from the store')
+parser_args.add_argument('--days', type=int, default=7)
+parser_args.add_argument('--url', help='url of the trend, top --limit urls by time sum by default')
+parser_args.add_argument('--limit', type=int, default=20)
+parser_args.add_argument('-p', '--profile', nargs='?', const='profile.json', default=None,
+                         help='write per-stage metrics to JSON file, path with other extension (.prof) '
+                              'gets cProfile statistics')
 args = parser_args.parse_args()
 
 detail_log = True if args.level == 'i' else False
@@ -32,23 +70,225 @@ config = {
     'REPORT_SIZE': 1000,
     'report_dir': './reports1',
     'log_dir': './log1',
-    'log_file': './report.log'
+    'log_file': './report.log',
+    'aggregate_mode': 'exact',
+    'quantile_error': 0.01,
+    'gz_reader': 'gzip',
+    'gz_threads': 2,
+    'line_parser': 'fast',
+    'cache_dir': './reports/.cache',
+    'follow_file': './log/nginx-access-ui.log',
+    'follow_interval': 60,
+    'follow_poll': 1,
+    'batch_workers': 4,
+    'url_rules': '',
+    'max_urls': 0,
+    'backend': 'auto',
+    'report_template': './report.html',
+    'extra_formats': '',
+    'store_path': './reports/stats.sqlite',
+    'regression_threshold': 0.2,
+    'regression_min_count': 10,
+    'log_depth': 0,
+    'log_index': './reports/.cache/logs.idx'
 }
 
 FilePath = namedtuple('FilePath', 'file_name date ext')
+Aggregate = namedtuple('Aggregate', 'url_stats total_amount total_time')
+
+AGGREGATE_CACHE_VERSION = 1
+URL_CACHE_SIZE = 1 << 17
+OTHER_URL = 'other'
+
+LOG_NAME_RE = re.compile(r'^nginx-access-ui(\.log|)-(\d{8})\.(gz|log)$')
+LOG_INDEX_VERSION = 1
+LOG_INDEX_RACY_NS = 2 * 10 ** 9
+
+TEMPLATE_FIELD = 'table_json'
+REPORT_BATCH = 1000
+report_templates = {}
+
+GZ_READ_SIZE = 1 << 18
+GZ_CHUNK_SIZE = 1 << 20
+GZ_QUEUE_SIZE = 8
+
+
+class Profiler:
+    """Metrics of pipeline stages: calls, items, bytes, wall and cpu time.
+        Time of nested stages is subtracted from the time of the enclosing one,
+        so every stage has the time of its own work. Time of a generator stage
+        is the time of its consumption, not of its creation.
+
+        Keyword arguments:
+        cprofile -- also collect cProfile statistics of the program
+        """
+
+    def __init__(self, cprofile=False, calibrate=True):
+        self.stages = {}
+        self.stack = []
+        self.overhead = self.calibrate() if calibrate else (0.0, 0.0, 0.0, 0.0)
+        self.start = time.perf_counter(), time.process_time()
+        self.cprofile = cProfile.Profile() if cprofile else None
+        if self.cprofile:
+            self.cprofile.enable()
+
+    def stage(self, name):
+        stat = self.stages.get(name)
+        if stat is None:
+            stat = self.stages[name] = {'calls': 0, 'items': 0, 'bytes': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                        'steps': 0, 'nested_steps': 0}
+        return stat
+
+    @staticmethod
+    def calibrate(steps=20000):
+        """Return wall and cpu time of profiling of one step charged to the stage
+            itself and to the enclosing stage, they are subtracted in report"""
+        profiler = Profiler(calibrate=False)
+        for _ in profiler.iterate('outer', profiler.iterate('inner', range(steps))):
+            pass
+        inner, outer = profiler.stages['inner'], profiler.stages['outer']
+        own_wall, own_cpu = inner['wall_time'] / inner['steps'], inner['cpu_time'] / inner['steps']
+        return (own_wall, own_cpu, max(outer['wall_time'] / outer['steps'] - own_wall, 0.0),
+                max(outer['cpu_time'] / outer['steps'] - own_cpu, 0.0))
+
+    def call(self, name, func, *args, **kwargs):
+        """Return result of func call recorded as the stage name"""
+        stat = self.stage(name)
+        stat['calls'] += 1
+        stack = self.stack
+        nested = [0.0, 0.0, 0]
+        stack.append(nested)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall_time, cpu_time = time.perf_counter() - start, time.process_time() - start_cpu
+            stack.pop()
+            stat['wall_time'] += wall_time - nested[0]
+            stat['cpu_time'] += cpu_time - nested[1]
+            stat['nested_steps'] += nested[2]
+            if stack:
+                stack[-1][0] += wall_time
+                stack[-1][1] += cpu_time
+
+    def iterate(self, name, iterable, size=None):
+        """Yield items of iterable, every step is recorded as the stage name.
+            Bookkeeping of a step is excluded from both the stage and the enclosing
+            stage, it is only a part of the total time.
+
+            Keyword arguments:
+            size -- function returning size of the item in bytes
+            """
+        stat = self.stage(name)
+        stat['calls'] += 1
+        stack = self.stack
+        clock, cpu_clock = time.perf_counter, time.process_time
+        items = iter(iterable)
+        wall_time = cpu_time = 0.0
+        count = size_sum = steps = nested_steps = 0
+        try:
+            while True:
+                nested = [0.0, 0.0, 0]
+                stack.append(nested)
+                start, start_cpu = clock(), cpu_clock()
+                done = False
+                try:
+                    item = next(items)
+                except StopIteration:
+                    done = True
+                finally:
+                    stop, stop_cpu = clock(), cpu_clock()
+                    stack.pop()
+                    wall_time += stop - start - nested[0]
+                    cpu_time += stop_cpu - start_cpu - nested[1]
+                    steps += 1
+                    nested_steps += nested[2]
+                if not done:
+                    count += 1
+                    if size is not None:
+                        size_sum += size(item)
+                if stack:
+                    stack[-1][0] += clock() - start
+                    stack[-1][1] += cpu_clock() - start_cpu
+                    stack[-1][2] += 1
+                if done:
+                    return
+                yield item
+        finally:
+            stat['items'] += count
+            stat['bytes'] += size_sum
+            stat['wall_time'] += wall_time
+            stat['cpu_time'] += cpu_time
+            stat['steps'] += steps
+            stat['nested_steps'] += nested_steps
+
+    def report(self):
+        """Return dictionary of total and per-stage metrics"""
+        own_wall, own_cpu, nested_wall, nested_cpu = self.overhead
+        stages = {}
+        for name, stat in self.stages.items():
+            stat = stat.copy()
+            steps, nested_steps = stat.pop('steps'), stat.pop('nested_steps')
+            wall_time = max(stat['wall_time'] - steps * own_wall - nested_steps * nested_wall, 0.0)
+            cpu_time = max(stat['cpu_time'] - steps * own_cpu - nested_steps * nested_cpu, 0.0)
+            stages[name] = dict(stat, wall_time=round(wall_time, 4), cpu_time=round(cpu_time, 4),
+                                items_per_sec=round(stat['items'] / wall_time) if stat['items'] and wall_time
+                                else None)
+        return {'wall_time': round(time.perf_counter() - self.start[0], 4),
+                'cpu_time': round(time.process_time() - self.start[1], 4), 'stages': stages}
+
+    def dump(self, path):
+        """Write metrics to JSON file, path with other extension gets pstats dump
+            of cProfile and metrics are written next to it"""
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(path)
+        metrics = self.report()
+        for name, stat in metrics['stages'].items():
+            logging.info(f'stage {name}: {stat}')
+        json_path = path if path.endswith('.json') else os.path.splitext(path)[0] + '.json'
+        with open(json_path, 'w') as f:
+            json.dump(metrics, f, indent=2)
+
+
+profiler = None
+
+
+def profile_call(name, func, *args, **kwargs):
+    """Return result of func call recorded as pipeline stage if profiling is enabled"""
+    if profiler is None:
+        return func(*args, **kwargs)
+    return profiler.call(name, func, *args, **kwargs)
+
+
+def profile_iter(name, iterable, size=None):
+    """Return iterable recorded as pipeline stage if profiling is enabled, see Profiler.iterate"""
+    return iterable if profiler is None else profiler.iterate(name, iterable, size)
 
 
 def log(msg_err=''):
     def dec(func):
+        generator = inspect.isgeneratorfunction(func)
+
         @wraps(func)
         def wrap(*args, **kwargs):
             try:
-                start_time = time.time()
-                result = func(*args, **kwargs)
+                start_time = time.perf_counter()
+                if generator:
+                    result = profile_iter(func.__name__, func(*args, **kwargs))
+                else:
+                    result = profile_call(func.__name__, func, *args, **kwargs)
                 if detail_log:
-                    msg = 'вызов функции {} с аргументами: {}, {} выполнен'.format(func.__name__, args, kwargs)
+                    # arguments are abbreviated, report rows are not copied into the log
+                    msg = 'вызов функции {} с аргументами: {}, {} выполнен'.format(func.__name__, reprlib.repr(args),
+                                                                                   reprlib.repr(kwargs))
                     logging.info(msg + '\n' + func.__doc__)
-                    logging.info(f'working time of function {func.__name__}: {time.time() - start_time} seconds')
+                    if generator:
+                        logging.info(f'function {func.__name__} returned generator, its working time is '
+                                     f'recorded with --profile')
+                    else:
+                        logging.info(f'working time of function {func.__name__}: '
+                                     f'{time.perf_counter() - start_time} seconds')
                 return result
             except:
                 logging.exception(msg_err)
@@ -73,42 +313,159 @@ def build_config():
     except configparser.ParsingError:
         sys.exit('Config file is incorrect. Fix and try again!')
 
-    for k in config.keys():
+    for k in list(config.keys()):
         config[k.lower()] = config.pop(k)
     config.update(dict(parser.items('SETTINGS')))
     cfg = config.copy()
     return cfg
 
 
+def log_date(date):
+    """Return datetime of YYYYMMDD string, faster than strptime"""
+    return datetime.datetime(int(date[:4]), int(date[4:6]), int(date[6:]))
+
+
+def parse_log_name(name):
+    """Return [date YYYYMMDD, extention] of log file name, None if it is not a log or the date is wrong"""
+    m = LOG_NAME_RE.match(name)
+    if not m:
+        return None
+    try:
+        log_date(m.group(2))
+    except ValueError:
+        logging.exception(f'The date in the file name {name} does not match YYYYMMDD')
+        return None
+    return [m.group(2), m.group(3)]
+
+
+def scan_dir(path, mtime_ns, entry=None):
+    """Return index entry of the directory: mtime, logs and subdirectories.
+        Names of logs known by the previous entry are not parsed again
+
+        Keyword arguments:
+        path -- directory
+        mtime_ns -- modification time of the directory
+        entry -- index entry of the previous scan
+        """
+    known = entry['logs'] if entry else {}
+    logs, dirs = {}, []
+    with os.scandir(path) as entries:
+        for dir_entry in entries:
+            name = dir_entry.name
+            if name in known:
+                logs[name] = known[name]
+            elif LOG_NAME_RE.match(name):
+                logs[name] = parse_log_name(name)
+            elif dir_entry.is_dir():
+                dirs.append(name)
+    # the directory may be changed again within the same mtime tick, it is rescanned next time
+    if time.time_ns() - mtime_ns < LOG_INDEX_RACY_NS:
+        mtime_ns = None
+    return {'mtime_ns': mtime_ns, 'logs': logs, 'dirs': sorted(dirs)}
+
+
+def scan_logs(log_dir, depth=0, index=None):
+    """Return list of named tuples with file name relative to log_dir, log date
+        and extention of logs in log_dir and its subdirectories down to depth
+        levels, and True if the index is changed. Directories whose mtime is
+        the same as in the index are not listed.
+
+        Keyword arguments:
+        log_dir -- log directory (str)
+        depth -- levels of subdirectories (hosts, years) scanned
+        index -- dict of absolute directory path: entry of scan_dir, updated in place
+        """
+    index = {} if index is None else index
+    root = os.path.abspath(log_dir)
+    file_paths, visited, changed = [], set(), False
+    dates = {}
+    stack = [('', 0)]
+    while stack:
+        rel_dir, level = stack.pop()
+        path = os.path.join(root, rel_dir) if rel_dir else root
+        visited.add(path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            logging.error(f'Log directory {path} is not available')
+            continue
+        entry = index.get(path)
+        if entry is None or entry['mtime_ns'] != mtime_ns:
+            entry = index[path] = scan_dir(path, mtime_ns, entry)
+            changed = True
+        prefix = rel_dir + os.sep if rel_dir else ''
+        for name, log_name in entry['logs'].items():
+            if log_name:
+                date, ext = log_name
+                file_date = dates.get(date)
+                if file_date is None:
+                    file_date = dates[date] = log_date(date)
+                file_paths.append(FilePath(prefix + name, file_date, ext))
+        if level < depth:
+            stack.extend((os.path.join(rel_dir, name), level + 1) for name in entry['dirs'])
+
+    # directories removed from the tree
+    for path in [path for path in index if (path == root or path.startswith(root + os.sep)) and path not in visited]:
+        del index[path]
+        changed = True
+    return file_paths, changed
+
+
+def load_log_index(index_path):
+    """Return directory index saved by save_log_index, empty index if it is absent or broken"""
+    try:
+        with open(index_path, 'rb') as f:
+            version, index = marshal.loads(f.read())
+        if version == LOG_INDEX_VERSION:
+            return index
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, EOFError, TypeError):
+        logging.exception('Error with loading log directory index')
+    return {}
+
+
+def save_log_index(index_path, index):
+    """Save directory index to marshal file"""
+    try:
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        with open(index_path + '.tmp', 'wb') as f:
+            f.write(marshal.dumps((LOG_INDEX_VERSION, index)))
+        os.replace(index_path + '.tmp', index_path)
+    except (OSError, ValueError):
+        logging.exception('Error with saving log directory index')
+
+
+@log('Error with finding log files')
+def find_logs(log_dir, depth=0, index_path=None):
+    """Return list of named tuples with file name, log date and extention
+        of all logs in log directory sorted by date.
+
+        Keyword arguments:
+        log_dir -- log directory (str)
+        depth -- levels of subdirectories scanned, file names of their logs are relative to log_dir
+        index_path -- file of the directory index, only changed directories are listed again
+
+        """
+    index = load_log_index(index_path) if index_path else {}
+    file_paths, changed = scan_logs(log_dir, int(depth or 0), index)
+    if index_path and changed:
+        save_log_index(index_path, index)
+    return sorted(file_paths, key=operator.attrgetter('date', 'file_name'))
+
+
 @log('Error with finding log file')
-def find_log(log_dir):
+def find_log(log_dir, depth=0, index_path=None):
     """Return named tuple with file name, log date and extention.
 
         Keyword arguments:
         config -- configuration parameters (dict)
+        depth, index_path -- see find_logs
 
         """
-    pattern = '^nginx-access-ui(\.log|)-\d{8}\.(gz|log)$'
-    max_date = datetime.datetime.strptime('1900-1-1 00:00:00', '%Y-%m-%d %H:%M:%S')
-    file_path = None
-    files = os.listdir(log_dir)
-
-    for file in files:
-        m = re.match(pattern, file)
-        if m:
-            # ext = 'gz' if file.endswith('.gz') else 'log'
-            ext = m.group(3)
-            try:
-                date = datetime.datetime.strptime(m.group(2), '%Y%m%d')
-                if date > max_date:
-                    file_path = FilePath(file, date, ext)
-                    max_date = date
-            except ValueError:
-                logging.exception(f'The date in the file name {file} does not match YYYYMMDD')
-            except:
-                logging.exception(f'Error with proccess of {file} file')
-    if file_path:
-        return file_path
+    file_paths = find_logs(log_dir, depth, index_path)
+    if file_paths:
+        return max(file_paths, key=lambda file_path: file_path.date)
     logging.info('No data to process')
 
 
@@ -121,110 +478,1421 @@ def open_file(file_dir, mode, encoding, ext=''):
         return open(file_dir, mode=mode, encoding=encoding)
 
 
+def bgzf_blocks(f):
+    """Yield compressed gzip members of indexed (bgzip) file. Stops before the first
+        member without block size in the extra field.
+
+        Keyword arguments:
+        f -- gzip file opened in binary mode
+        """
+    while True:
+        start = f.tell()
+        header = f.read(12)
+        bsize = None
+        if len(header) == 12 and header[:4] == b'\x1f\x8b\x08\x04':
+            xlen = struct.unpack('<H', header[10:12])[0]
+            extra = f.read(xlen)
+            pos = 0
+            while pos + 4 <= len(extra):
+                slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+                if extra[pos:pos + 2] == b'BC' and slen == 2:
+                    bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+                pos += 4 + slen
+        if bsize is None:
+            f.seek(start)
+            return
+        yield header + extra + f.read(bsize + 1 - 12 - xlen)
+
+
+def is_bgzf(file_dir):
+    """Return True if gzip file consists of members with block sizes (bgzip format)"""
+    with open(file_dir, 'rb') as f:
+        return next(bgzf_blocks(f), None) is not None
+
+
+def inflate_stream(f):
+    """Yield decompressed data of single or multi-member gzip file"""
+    decompressor, started = zlib.decompressobj(31), False
+    while True:
+        data = f.read(GZ_READ_SIZE)
+        if not data:
+            break
+        while data:
+            started = True
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor, started = zlib.decompressobj(31), False
+    if started and not decompressor.eof:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def inflate_blocks(f, threads):
+    """Yield decompressed data of bgzip file, members are inflated in parallel threads"""
+    pending = deque()
+    chunk = []
+    size = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for block in bgzf_blocks(f):
+            pending.append(executor.submit(zlib.decompress, block, 31))
+            if len(pending) < threads * 4:
+                continue
+            data = pending.popleft().result()
+            chunk.append(data)
+            size += len(data)
+            if size >= GZ_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk, size = [], 0
+        while pending:
+            chunk.append(pending.popleft().result())
+    if chunk:
+        yield b''.join(chunk)
+    # members without block size are inflated sequentially
+    yield from inflate_stream(f)
+
+
+def read_gz_chunks(file_dir, threads=1):
+    """Yield decompressed chunks of gzip file. Inflating runs in background thread
+        and overlaps with processing of chunks; members of bgzip file are inflated
+        by several threads.
+
+        Keyword arguments:
+        file_dir -- path to gzip file
+        threads -- number of threads inflating bgzip members
+        """
+    chunks = queue.Queue(maxsize=GZ_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def inflate():
+        try:
+            indexed = threads > 1 and is_bgzf(file_dir)
+            with open(file_dir, 'rb') as f:
+                for chunk in (inflate_blocks(f, threads) if indexed else inflate_stream(f)):
+                    if not put(chunk):
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=inflate, daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        reader.join()
+
+
+def iter_chunk_lines(chunks, encoding='utf-8'):
+    """Yield text lines of stream of byte chunks, bytes lines if encoding is None"""
+    tail = b''
+    for chunk in chunks:
+        cut = chunk.rfind(b'\n')
+        if cut == -1:
+            tail += chunk
+            continue
+        if encoding:
+            yield from (tail + chunk[:cut]).decode(encoding).split('\n')
+        else:
+            yield from (tail + chunk[:cut]).split(b'\n')
+        tail = chunk[cut + 1:]
+    if tail:
+        yield tail.decode(encoding) if encoding else tail
+
+
+def iter_log_lines(file_dir, ext, gz_reader='gzip', gz_threads=1):
+    """Yield text lines of log file
+
+        Keyword arguments:
+        file_dir -- path to log file
+        ext -- file extention
+        gz_reader -- 'gzip' reads .gz file with gzip module, 'threaded' inflates it in background thread(s)
+        gz_threads -- number of threads inflating members of bgzip file
+        """
+    if ext == 'gz' and gz_reader == 'threaded':
+        yield from profile_iter('split', iter_chunk_lines(profile_iter('gzip', read_gz_chunks(file_dir,
+                                                                                              int(gz_threads)), len)))
+    else:
+        with open_file(file_dir, 'rt', 'utf-8', ext=ext) as f:
+            # reading, inflating and decoding of text file are one stage, its bytes are counted
+            # in utf-8 as the bytes of the other readers
+            yield from profile_iter('read', f, lambda line: len(line.encode('utf-8')))
+
+
+def iter_log_chunks(file_dir, ext, gz_reader='gzip', gz_threads=1):
+    """Yield byte chunks of log file, arguments are the same as in iter_log_lines"""
+    if ext == 'gz' and gz_reader == 'threaded':
+        yield from read_gz_chunks(file_dir, int(gz_threads))
+    else:
+        with open_file(file_dir, 'rb', None, ext=ext) as f:
+            yield from iter(lambda: f.read(GZ_CHUNK_SIZE), b'')
+
+
+def iter_plain_lines(file_dir, start=0, end=None):
+    """Yield bytes lines of uncompressed file with buffered reader
+
+        Keyword arguments:
+        file_dir -- path to uncompressed log file
+        start, end -- byte range aligned to line starts, the whole file by default
+        """
+    with open(file_dir, 'rb') as f:
+        f.seek(start)
+        if end is None:
+            yield from f
+            return
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line
+
+
+def iter_log_byte_lines(file_dir, ext, gz_reader='gzip', gz_threads=1):
+    """Yield bytes lines of log file, uncompressed files are read with
+        iter_plain_lines, gzip files as in iter_log_lines"""
+    if ext == 'gz':
+        chunks = profile_iter('gzip', iter_log_chunks(file_dir, ext, gz_reader, gz_threads), len)
+        yield from profile_iter('split', iter_chunk_lines(chunks, None))
+    else:
+        # lines are sliced from the file, reading and splitting are one stage
+        yield from profile_iter('read', iter_plain_lines(file_dir), len)
+
+
+def parse_line(line):
+    """Return [url, request_time] of the log line. Reference parser of text lines"""
+    line = line.split()
+    return [line[6], float(line[len(line) - 1])]
+
+
+def parse_url_rules(text):
+    """Return list of (pattern, replacement) url normalization rules
+
+        Keyword arguments:
+        text -- rules "pattern => replacement", one per line
+        """
+    rules = []
+    for line in (text or '').splitlines():
+        if line.strip():
+            pattern, _, replacement = line.partition('=>')
+            rules.append((pattern.strip(), replacement.strip()))
+    return rules
+
+
+def url_normalizer(url_rules):
+    """Return function applying precompiled normalization rules to url,
+        None if there are no rules. Results are cached for repeated urls.
+
+        Keyword arguments:
+        url_rules -- list of (pattern, replacement), see parse_url_rules
+        """
+    if not url_rules:
+        return None
+    rules = [(re.compile(pattern).sub, replacement) for pattern, replacement in url_rules]
+    cache = {}
+
+    def normalize(url):
+        result = cache.get(url)
+        if result is None:
+            result = url
+            for sub, replacement in rules:
+                result = sub(replacement, result)
+            if len(cache) >= URL_CACHE_SIZE:
+                cache.clear()
+            cache[url] = result
+        return result
+    return normalize
+
+
+def fast_line_parser(url_rules=None):
+    """Return function parsing bytes log line into [url, request_time].
+
+        Only the first 7 fields and the last one are split off, the line is
+        not decoded. Every distinct url is decoded and normalized once and
+        then taken from the cache.
+
+        Keyword arguments:
+        url_rules -- url normalization rules, see parse_url_rules
+        """
+    urls = {}
+    normalize = url_normalizer(url_rules)
+
+    def parse(line):
+        raw = line.split(None, 7)[6]
+        url = urls.get(raw)
+        if url is None:
+            url = raw.decode('utf-8')
+            if normalize:
+                url = normalize(url)
+            if len(urls) >= URL_CACHE_SIZE:
+                urls.clear()
+            urls[raw] = url
+        return [url, float(line.rsplit(None, 1)[1])]
+    return parse
+
+
+def check_err_rate(total_lines, err_counts, err_lines):
+    """Stop the program if the share of unparsed lines exceeds err_lines percent"""
+    if total_lines and err_counts / total_lines * 100 > float(err_lines):
+        logging.error(f"Allowed error rate {err_lines} exceeded")
+        sys.exit('Allowed error rate exceeded. Report not generated')
+
+
 @log('File parsing error')
-def parser_log(file_path, log_dir, err_lines):
+def parser_log(file_path, log_dir, err_lines, gz_reader='gzip', gz_threads=1, line_parser='split', url_rules=None):
     """Return generator object.
 
         Keyword arguments:
         config -- configuration parameters (dict)
         file_path -- named tuple = the result of find_log function
+        gz_reader, gz_threads -- the way of reading .gz files, see iter_log_lines
+        line_parser -- 'split' parses text lines with parse_line, 'fast' parses bytes lines with fast_line_parser
+        url_rules -- url normalization rules, see parse_url_rules
         """
     file_dir = os.path.join(log_dir, file_path.file_name)
     # if os.stat(file_dir).st_size != 0:
     # f = gzip.open(file_dir, mode='rb') if file_path.ext == 'gz' else open(
     #     file_dir, encoding='utf-8')
+    if line_parser == 'fast':
+        lines = iter_log_byte_lines(file_dir, file_path.ext, gz_reader, gz_threads)
+        parse = fast_line_parser(url_rules)
+    else:
+        lines = iter_log_lines(file_dir, file_path.ext, gz_reader, gz_threads)
+        parse = parse_line
+        normalize = url_normalizer(url_rules)
+        if normalize:
+            def parse(line):
+                url, time_request = parse_line(line)
+                return [normalize(url), time_request]
     total_lines = err_counts = 0
-    with open_file(file_dir, 'rt', 'utf-8', ext=file_path.ext) as f:
-        for line in f:
+    for line in lines:
+        total_lines += 1
+        try:
+            # if line.find(' "0" ') != -1:
+            #     continue
+            yield parse(line)
+        except:
+            err_counts += 1
+    check_err_rate(total_lines, err_counts, err_lines)
+
+
+def split_file(file_dir, parts):
+    """Return list of (start, end) byte ranges of the file aligned to line starts
+
+        Keyword arguments:
+        file_dir -- path to uncompressed log file
+        parts -- required number of ranges
+        """
+    size = os.path.getsize(file_dir)
+    bounds = [0]
+    with open(file_dir, 'rb') as f:
+        for i in range(1, parts):
+            pos = max(size * i // parts, bounds[-1])
+            if pos >= size:
+                break
+            # the file is smaller than parts, the first range starts at 0 anyway
+            if pos == 0:
+                continue
+            f.seek(pos - 1)
+            f.readline()
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def aggregate_range(file_dir, start, end, rel_error=None, line_parser='split', url_rules=None, max_urls=0,
+                    backend='python'):
+    """Return partial aggregate of the byte range of the log file:
+        url_stats, total_amount, total_time, total_lines, err_counts
+
+        Keyword arguments:
+        file_dir -- path to uncompressed log file
+        start, end -- byte range, both aligned to line starts
+        rel_error -- relative error of quantile sketches, None for exact mode
+        line_parser -- 'split' or 'fast', see parser_log
+        url_rules -- url normalization rules, see parse_url_rules
+        max_urls -- max number of tracked urls, see accumulate_stat
+        backend -- aggregation backend, see accumulate_stat
+        """
+    def lines():
+        nonlocal total_lines, err_counts
+        if line_parser == 'fast':
+            parse = fast_line_parser(url_rules)
+        else:
+            normalize = url_normalizer(url_rules) or (lambda url: url)
+
+            def parse(line):
+                url, time_request = parse_line(line.decode('utf-8'))
+                return [normalize(url), time_request]
+        for line in iter_plain_lines(file_dir, start, end):
             total_lines += 1
             try:
-                # line = line.decode('utf-8') if file_path.ext == 'gz' else line
-                # if line.find(' "0" ') != -1:
-                #     continue
-                line = line.split()
-                url = line[6]
-                time_request = float(line[len(line) - 1])
-                parsed_line = [url, time_request]
-                yield parsed_line
+                yield parse(line)
             except:
                 err_counts += 1
-    if total_lines and err_counts / total_lines * 100 > float(err_lines):
-        logging.error(f"Allowed error rate {err_lines} exceeded")
-        sys.exit('Allowed error rate exceeded. Report not generated')
+
+    total_lines = err_counts = 0
+    url_stats, total_amount, total_time = accumulate_stat(lines(), rel_error, max_urls, backend)
+    return url_stats, total_amount, total_time, total_lines, err_counts
+
+
+def collect_parallel(file_path, log_dir, err_lines, workers, rel_error=None, line_parser='split', url_rules=None,
+                     max_urls=0, backend='python'):
+    """Return Aggregate of uncompressed log file parsed in several processes,
+        arguments are the same as in aggregate_parallel"""
+    file_dir = os.path.join(log_dir, file_path.file_name)
+    ranges = split_file(file_dir, workers)
+
+    url_stats = {}
+    total_amount = total_time = total_lines = err_counts = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(aggregate_range, file_dir, start, end, rel_error, line_parser, url_rules,
+                                   max_urls, backend)
+                   for start, end in ranges]
+        # partial aggregates are merged in file order
+        for future in futures:
+            part_stats, part_amount, part_time, part_lines, part_errors = future.result()
+            for url, stat in part_stats.items():
+                merged = url_stats.get(url)
+                if merged is None:
+                    url_stats[url] = stat
+                else:
+                    merged.merge(stat)
+            total_amount += part_amount
+            total_time += part_time
+            total_lines += part_lines
+            err_counts += part_errors
+
+    check_err_rate(total_lines, err_counts, err_lines)
+    return Aggregate(cap_url_stats(url_stats, max_urls, rel_error), total_amount, total_time)
+
+
+@log('Error with parallel parsing of log file')
+def aggregate_parallel(file_path, log_dir, err_lines, workers, mode='exact', rel_error=0.01, line_parser='split',
+                       url_rules=None, max_urls=0, backend='python'):
+    """Function aggregates statistics of uncompressed log file in several processes
+
+        Keyword arguments:
+        file_path -- named tuple = the result of find_log function
+        log_dir -- log directory (str)
+        err_lines -- allowed percent of unparsed lines
+        workers -- number of processes
+        mode -- 'exact' keeps all request times, 'sketch' keeps quantile sketches
+        rel_error -- relative error of medians and percentiles in sketch mode
+        line_parser -- 'split' or 'fast', see parser_log
+        url_rules -- url normalization rules, see parse_url_rules
+        max_urls -- max number of tracked urls, see accumulate_stat
+        backend -- aggregation backend, see accumulate_stat
+        """
+    aggregate = collect_parallel(file_path, log_dir, err_lines, workers, get_rel_error(mode, rel_error),
+                                 line_parser, url_rules, max_urls, backend)
+    if aggregate.total_amount:
+        return build_report_rows(*aggregate)
+    logging.info('The file is empty. Report not generated')
+
+
+def report_file_name(file_path):
+    """Return file name of the report of the log: report-YYYY.MM.DD.html, logs in
+        subdirectories of log_dir get them in the name: report-host-YYYY.MM.DD.html"""
+    subdir = os.path.dirname(file_path.file_name).replace(os.sep, '-')
+    return 'report-' + (subdir + '-' if subdir else '') + file_path.date.strftime('%Y.%m.%d') + '.html'
 
 
 @log()
-def is_report_exist(file_date, report_dir):
+def is_report_exist(file_date, report_dir, report_name=None):
     """Return boolean value. Check if report on required date already exists
 
         Keyword arguments:
         file_date -- required date
         config -- configuration parameters (dict)
+        report_name -- file name of the report, see report_file_name
         """
-    return os.path.exists(os.path.join(report_dir, 'report-' + file_date.strftime("%Y.%m.%d") + '.html'))
+    return os.path.exists(os.path.join(report_dir, report_name or 'report-' + file_date.strftime("%Y.%m.%d") + '.html'))
 
 
-@log('Error with preparing aggregate statistics')
-def aggregate_stat(file_path, log):
-    """Function aggregates statistics
+class QuantileSketch:
+    """Mergeable quantile sketch with a bounded relative error.
+
+        Values are counted in logarithmic buckets, so memory depends on the
+        spread of request times, not on the number of samples, and every
+        quantile is returned within rel_error of the true value.
 
         Keyword arguments:
-        file_path -- named tuple = the result of find_log function
-        log_dir -- log directory (str)
+        rel_error -- relative error bound of quantiles (float)
         """
+    __slots__ = ('rel_error', 'gamma', 'log_gamma', 'bins', 'zeros', 'count')
 
-    url_stats = defaultdict(list)
-    report_url = []
+    def __init__(self, rel_error=0.01):
+        self.rel_error = rel_error
+        self.gamma = (1 + rel_error) / (1 - rel_error)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+        else:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other):
+        if other.rel_error != self.rel_error:
+            raise ValueError('Sketches with different error bounds can not be merged')
+        self.count += other.count
+        self.zeros += other.zeros
+        for key, n in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + n
+
+    def dump(self):
+        return self.count, self.zeros, self.bins
+
+    @classmethod
+    def load(cls, data, rel_error):
+        sketch = cls(rel_error)
+        sketch.count, sketch.zeros, sketch.bins = data
+        return sketch
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+class UrlStat:
+    """Per-url accumulator of request times.
+
+        Count, sum and max are always exact. Median and percentiles are
+        computed from the full list of times (exact mode) or from
+        a QuantileSketch (sketch mode).
+
+        Keyword arguments:
+        rel_error -- relative error of the sketch, None keeps all times
+        """
+    __slots__ = ('count', 'time_sum', 'time_max', 'times', 'sketch', 'median')
+
+    def __init__(self, rel_error=None):
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = float('-inf')
+        self.times = [] if rel_error is None else None
+        self.sketch = QuantileSketch(rel_error) if rel_error is not None else None
+        # median precomputed by accumulate_columns
+        self.median = None
+
+    def add(self, time_request):
+        self.median = None
+        self.count += 1
+        self.time_sum += time_request
+        if time_request > self.time_max:
+            self.time_max = time_request
+        if self.sketch is None:
+            self.times.append(time_request)
+        else:
+            self.sketch.add(time_request)
+
+    def merge(self, other):
+        self.median = None
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        if self.sketch is None:
+            self.times.extend(other.times)
+        else:
+            self.sketch.merge(other.sketch)
+
+    def dump(self):
+        """Return tuple of builtin types for marshal"""
+        data = array('d', self.times).tobytes() if self.sketch is None else self.sketch.dump()
+        return self.count, self.time_sum, self.time_max, data
+
+    @classmethod
+    def load(cls, record, rel_error=None):
+        stat = cls.__new__(cls)
+        stat.median = None
+        stat.count, stat.time_sum, stat.time_max, data = record
+        if rel_error is None:
+            times = array('d')
+            times.frombytes(data)
+            stat.times, stat.sketch = times.tolist(), None
+        else:
+            stat.times, stat.sketch = None, QuantileSketch.load(data, rel_error)
+        return stat
+
+    def mean(self):
+        if self.sketch is None:
+            return statistics.mean(self.times)
+        return self.time_sum / self.count
+
+    def quantile(self, q):
+        if self.sketch is None:
+            if q == 0.5:
+                return statistics.median(self.times) if self.median is None else self.median
+            times = sorted(self.times)
+            return times[round(q * (len(times) - 1))]
+        return self.sketch.quantile(q)
+
+    def quantiles(self, qs):
+        """Return list of quantiles qs, the times are sorted once"""
+        if self.sketch is not None:
+            return [self.sketch.quantile(q) for q in qs]
+        times = sorted(self.times)
+        return [statistics.median(times) if q == 0.5 else times[round(q * (len(times) - 1))] for q in qs]
+
+
+class SpaceSaving:
+    """Tracker of at most max_urls most frequent urls (Space-Saving algorithm).
+
+        When a new url comes and max_urls urls are tracked, the url with the
+        lowest estimated count is evicted: its statistics are merged into the
+        OTHER_URL bucket and the new url inherits its count as an error of the
+        estimate. So every url with more than 1/max_urls of all requests stays
+        tracked. Statistics of tracked urls are exact since they were added.
+
+        Keyword arguments:
+        max_urls -- max number of tracked urls
+        rel_error -- relative error of quantile sketches, None for exact mode
+        """
+
+    def __init__(self, max_urls, rel_error=None):
+        self.max_urls = max_urls
+        self.rel_error = rel_error
+        self.url_stats = {}
+        self.errors = {}
+        self.heap = []
+        self.other = UrlStat(rel_error)
+
+    def get(self, url):
+        """Return UrlStat of the url, the least frequent url is evicted if needed"""
+        stat = self.url_stats.get(url)
+        if stat is None:
+            error = self.evict() if len(self.url_stats) >= self.max_urls else 0
+            stat = self.url_stats[url] = UrlStat(self.rel_error)
+            self.errors[url] = error
+            heapq.heappush(self.heap, (error, url))
+        return stat
+
+    def evict(self):
+        # heap keys are lower bounds of estimates, refresh them until the minimum is exact
+        while True:
+            estimate, url = heapq.heappop(self.heap)
+            current = self.url_stats[url].count + self.errors[url]
+            if current == estimate:
+                break
+            heapq.heappush(self.heap, (current, url))
+        self.other.merge(self.url_stats.pop(url))
+        del self.errors[url]
+        return estimate
+
+    def stats(self):
+        """Return dict of url: UrlStat including OTHER_URL bucket"""
+        url_stats = dict(self.url_stats)
+        if self.other.count:
+            url_stats[OTHER_URL] = self.other
+        return url_stats
+
+
+def cap_url_stats(url_stats, max_urls, rel_error=None):
+    """Return url_stats with at most max_urls most frequent urls, the rest are
+        merged into OTHER_URL bucket
+
+        Keyword arguments:
+        url_stats -- dict of url: UrlStat
+        max_urls -- max number of urls, 0 is unlimited
+        rel_error -- relative error of quantile sketches, None for exact mode
+        """
+    max_urls = int(max_urls or 0)
+    if not max_urls or len(url_stats) - (OTHER_URL in url_stats) <= max_urls:
+        return url_stats
+    other = url_stats.pop(OTHER_URL, None) or UrlStat(rel_error)
+    top = {url for url, _ in heapq.nlargest(max_urls, url_stats.items(), key=lambda item: item[1].count)}
+    capped = {}
+    for url, stat in url_stats.items():
+        if url in top:
+            capped[url] = stat
+        else:
+            other.merge(stat)
+    capped[OTHER_URL] = other
+    return capped
+
+
+def use_numpy(backend, rel_error=None, max_urls=0):
+    """Return True if the aggregate is computed by accumulate_columns: backend is
+        'numpy' or 'auto' and NumPy is installed, exact mode without url cap"""
+    if backend not in ('auto', 'numpy') or rel_error is not None or int(max_urls or 0):
+        return False
+    if np is None:
+        if backend == 'numpy':
+            logging.error('NumPy is not installed, python backend is used')
+        return False
+    return True
+
+
+def accumulate_columns(log):
+    """Return per-url accumulators, total amount and total time of requests
+        computed with NumPy. Urls are interned to integer ids, ids and request
+        times are collected into arrays and count, sum, max and median of every
+        url are computed with vectorized group-by. The result is equal to
+        accumulate_stat in exact mode.
+
+        Keyword arguments:
+        log -- iterable of [url, request_time] pairs
+        """
+    url_ids = {}
+    ids = array('q')
+    times = array('d')
+    add_id, add_time = ids.append, times.append
+    for url, time_request in log:
+        url_id = url_ids.get(url)
+        if url_id is None:
+            url_id = url_ids[url] = len(url_ids)
+        add_id(url_id)
+        add_time(time_request)
+    if not times:
+        return Aggregate({}, 0, 0)
+
+    ids = np.frombuffer(ids, dtype=np.int64)
+    times = np.frombuffer(times, dtype=np.float64)
+    n = len(url_ids)
+    # bincount and accumulate add values in file order, as the python backend does
+    counts = np.bincount(ids, minlength=n)
+    sums = np.bincount(ids, weights=times, minlength=n)
+    total_time = np.add.accumulate(times)[-1]
+    maxes = np.full(n, -np.inf)
+    np.maximum.at(maxes, ids, times)
+    sorted_times = times[np.lexsort((times, ids))]
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    medians = (sorted_times[starts + (counts - 1) // 2] + sorted_times[starts + counts // 2]) / 2
+
+    sorted_times = sorted_times.tolist()
+    url_stats = {}
+    columns = zip(url_ids, counts.tolist(), sums.tolist(), maxes.tolist(), medians.tolist(),
+                  starts.tolist(), ends.tolist())
+    for url, count, time_sum, time_max, median, start, end in columns:
+        stat = url_stats[url] = UrlStat.__new__(UrlStat)
+        stat.count, stat.time_sum, stat.time_max, stat.median = count, time_sum, time_max, median
+        stat.times, stat.sketch = sorted_times[start:end], None
+    return Aggregate(url_stats, len(times), float(total_time))
+
+
+def accumulate_stat(log, rel_error=None, max_urls=0, backend='python'):
+    """Return per-url accumulators, total amount and total time of requests
+
+        Keyword arguments:
+        log -- iterable of [url, request_time] pairs
+        rel_error -- relative error of quantile sketches, None for exact mode
+        max_urls -- max number of tracked urls, requests of the others go
+                    to OTHER_URL bucket (0 is unlimited)
+        backend -- 'python', 'numpy' or 'auto' (numpy if installed), see use_numpy
+        """
+    if use_numpy(backend, rel_error, max_urls):
+        return accumulate_columns(log)
+    max_urls = int(max_urls or 0)
+    url_stats = {}
     total_amount = total_time = 0
+    tracker = SpaceSaving(max_urls, rel_error) if max_urls else None
 
     for url, time_request in log:
-        url_stats[url].append(time_request)      
+        if tracker:
+            stat = tracker.get(url)
+        else:
+            stat = url_stats.get(url)
+            if stat is None:
+                stat = url_stats[url] = UrlStat(rel_error)
+        stat.add(time_request)
 
         total_amount += 1
         total_time += time_request
+    if tracker:
+        url_stats = tracker.stats()
+    return Aggregate(url_stats, total_amount, total_time)
+
+
+def build_report_rows(url_stats, total_amount, total_time, report_size=None):
+    """Return report rows sorted by time_sum. With report_size only the top
+        urls by time_sum are selected and only their rows are built.
+
+        Keyword arguments:
+        url_stats -- dict of url: UrlStat
+        total_amount -- total amount of requests
+        total_time -- total time of requests
+        report_size -- number of rows, all urls by default
+        """
+    def time_sum(item):
+        return round(item[1].time_sum, 3)
+
+    if report_size is None:
+        top = sorted(url_stats.items(), key=time_sum, reverse=True)
+    else:
+        top = heapq.nlargest(int(report_size), url_stats.items(), key=time_sum)
+
+    report_url = []
+    for k, v in top:
+        count = v.count
+        count_perc = round(count / total_amount, 3) * 100
+        time_sum = v.time_sum
+        time_perc = round((time_sum / total_time * 100), 2)
+        row = {'url': k, 'count': count, 'count_perc': count_perc,
+               'time_avg': round(v.mean(), 3), 'time_max': v.time_max,
+               'time_med': round(v.quantile(0.5), 3), 'time_perc': time_perc, 'time_sum': round(time_sum, 3)}
+        if v.sketch is not None:
+            row['time_p95'] = round(v.quantile(0.95), 3)
+            row['time_p99'] = round(v.quantile(0.99), 3)
+        report_url.append(row)
+    return report_url
+
+
+@log('Error with preparing aggregate statistics')
+def aggregate_stat(file_path, log, mode='exact', rel_error=0.01, report_size=None, backend='python'):
+    """Function aggregates statistics
+
+        Keyword arguments:
+        file_path -- named tuple = the result of find_log function
+        log -- generator object = the result of parser_log function
+        mode -- 'exact' keeps all request times, 'sketch' keeps quantile sketches
+        rel_error -- relative error of medians and percentiles in sketch mode
+        report_size -- number of top urls by time_sum, all urls by default
+        backend -- aggregation backend, see accumulate_stat
+        """
+    aggregate = accumulate_stat(log, get_rel_error(mode, rel_error), backend=backend)
 
-    if total_amount:
-        for k, v in url_stats.items():
-            count = len(v)
-            count_perc = round(count / total_amount, 3) * 100
-            time_avg = round(statistics.mean(v), 3)
-            time_max = max(v)
-            time_med = round(statistics.median(v), 3)
-            time_sum = sum(v)
-            time_perc = round((time_sum / total_time * 100), 2)
-
-            report_url.append({'url': k, 'count': count, 'count_perc': count_perc,
-                               'time_avg': time_avg, 'time_max': time_max,
-                               'time_med': time_med, 'time_perc': time_perc, 'time_sum': round(time_sum, 3)})
-
-        report_url = sorted(report_url, key=lambda url: url['time_sum'], reverse=True)
-        return report_url
+    if aggregate.total_amount:
+        return build_report_rows(*aggregate, report_size)
     logging.info('The file is empty. Report not generated')
 
 
+def get_rel_error(mode, rel_error):
+    """Return relative error of quantile sketches for aggregation mode, None for exact mode"""
+    return float(rel_error) if mode == 'sketch' else None
+
+
+@log('Error with collecting statistics')
+def collect_stat(file_path, config, workers=1):
+    """Return Aggregate of the log file: per-url accumulators and totals
+
+        Keyword arguments:
+        file_path -- named tuple = the result of find_log function
+        config -- configuration parameters (dict)
+        workers -- number of processes parsing uncompressed log file
+        """
+    rel_error = get_rel_error(config.get('aggregate_mode'), config.get('quantile_error'))
+    url_rules = parse_url_rules(config.get('url_rules'))
+    max_urls = int(config.get('max_urls') or 0)
+    if workers > 1 and file_path.ext == 'log':
+        return collect_parallel(file_path, config.get('log_dir'), config.get('err_lines'), workers, rel_error,
+                                config.get('line_parser'), url_rules, max_urls, config.get('backend'))
+    log = parser_log(file_path, config.get('log_dir'), config.get('err_lines'),
+                     config.get('gz_reader'), config.get('gz_threads'), config.get('line_parser'), url_rules)
+    return accumulate_stat(log, rel_error, max_urls, config.get('backend'))
+
+
+def aggregate_settings(config):
+    """Return settings the aggregate depends on besides aggregation mode: url rules and max_urls"""
+    return tuple(parse_url_rules(config.get('url_rules'))), int(config.get('max_urls') or 0)
+
+
+def cache_name(file_dir, file_name=None):
+    """Return name of the log in aggregate cache: file_name relative to log_dir (base name of file_dir
+        by default) with subdirectories flattened as in report_file_name, host1-nginx-access-ui-YYYYMMDD.log"""
+    return (file_name or os.path.basename(file_dir)).replace(os.sep, '-')
+
+
+def cache_key(file_dir, rel_error, settings=(), file_name=None):
+    """Return key of aggregate cache: file name, size and mtime of the log, aggregation mode and settings"""
+    st = os.stat(file_dir)
+    return (AGGREGATE_CACHE_VERSION, cache_name(file_dir, file_name), st.st_size, st.st_mtime_ns, rel_error,
+            settings)
+
+
+def cache_path(cache_dir, file_dir, file_name=None):
+    return os.path.join(cache_dir, cache_name(file_dir, file_name) + '.agg')
+
+
+def save_aggregate(cache_dir, file_dir, aggregate, rel_error=None, settings=(), file_name=None):
+    """Save aggregate of the log file to binary sidecar file in cache_dir
+
+        Keyword arguments:
+        cache_dir -- directory of cache files
+        file_dir -- path to log file
+        aggregate -- Aggregate of the log file
+        rel_error -- relative error of quantile sketches, None for exact mode
+        settings -- other aggregation settings, see aggregate_settings
+        file_name -- path of the log relative to log_dir, logs of different hosts get different sidecars
+        """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = cache_path(cache_dir, file_dir, file_name)
+        records = [(url, stat.dump()) for url, stat in aggregate.url_stats.items()]
+        header = marshal.dumps(cache_key(file_dir, rel_error, settings, file_name))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(struct.pack('<I', len(header)) + header)
+            f.write(marshal.dumps((aggregate.total_amount, aggregate.total_time, records)))
+        os.replace(path + '.tmp', path)
+        logging.info(f'Aggregate is cached: {path}')
+    except (OSError, ValueError):
+        logging.exception('Error with saving aggregate cache')
+
+
+def load_aggregate(cache_dir, file_dir, rel_error=None, settings=(), file_name=None):
+    """Return Aggregate of the log file from cache_dir or None if there is no
+        cache or the log file was changed since it was cached
+
+        Keyword arguments:
+        cache_dir -- directory of cache files
+        file_dir -- path to log file
+        rel_error -- relative error of quantile sketches, None for exact mode
+        settings -- other aggregation settings, see aggregate_settings
+        file_name -- path of the log relative to log_dir, see save_aggregate
+        """
+    path = cache_path(cache_dir, file_dir, file_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            size = struct.unpack('<I', f.read(4))[0]
+            if marshal.loads(f.read(size)) != cache_key(file_dir, rel_error, settings, file_name):
+                return None
+            total_amount, total_time, records = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError, struct.error):
+        logging.exception(f'Error with loading aggregate cache {path}')
+        return None
+    url_stats = {url: UrlStat.load(record, rel_error) for url, record in records}
+    return Aggregate(url_stats, total_amount, total_time)
+
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    date TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    total_amount INTEGER NOT NULL,
+    total_time REAL NOT NULL,
+    rel_error REAL
+);
+CREATE TABLE IF NOT EXISTS url_stats (
+    date TEXT NOT NULL,
+    url TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    time_sum REAL NOT NULL,
+    time_max REAL NOT NULL,
+    time_med REAL NOT NULL,
+    time_p95 REAL NOT NULL,
+    time_p99 REAL NOT NULL,
+    sketch BLOB,
+    PRIMARY KEY (date, url)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS url_stats_url ON url_stats (url, date);
+"""
+
+
+def open_store(store_path):
+    """Return connection to SQLite store of daily url aggregates, the schema is created if needed"""
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    # batch workers write concurrently, one transaction waits for another
+    conn = sqlite3.connect(store_path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(STORE_SCHEMA)
+    return conn
+
+
+def store_aggregate(store_path, file_path, aggregate, rel_error=None, replace=True):
+    """Save per-url count, time sum, max, quantiles and quantile sketch of the log
+        day to the store. Rows of the day are replaced, with replace=False the day
+        is saved only if it is not in the store yet
+
+        Keyword arguments:
+        store_path -- path to SQLite file
+        file_path -- named tuple = the result of find_log function
+        aggregate -- Aggregate of the log file
+        rel_error -- relative error of quantile sketches, None for exact mode
+        """
+    date = file_path.date.strftime('%Y-%m-%d')
+    try:
+        conn = open_store(store_path)
+        try:
+            with conn:
+                if not replace and conn.execute('SELECT 1 FROM days WHERE date = ?', (date,)).fetchone():
+                    return
+                conn.execute('DELETE FROM url_stats WHERE date = ?', (date,))
+                conn.execute('INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?)',
+                             (date, file_path.file_name, aggregate.total_amount, aggregate.total_time, rel_error))
+                conn.executemany('INSERT INTO url_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 ((date, url, stat.count, stat.time_sum, stat.time_max,
+                                   *stat.quantiles((0.5, 0.95, 0.99)),
+                                   None if stat.sketch is None else marshal.dumps(stat.sketch.dump()))
+                                  for url, stat in aggregate.url_stats.items()))
+            logging.info(f'Aggregate of {date} is saved to store {store_path}')
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        logging.exception('Error with saving aggregate to store')
+
+
+def store_days(conn, days):
+    """Return list of the last days dates in the store, oldest first"""
+    return [date for date, in conn.execute('SELECT date FROM days ORDER BY date DESC LIMIT ?', (days,))][::-1]
+
+
+def query_trend(conn, days, url=None, limit=10):
+    """Return rows of daily count, average, max, median and 95th percentile of
+        request time of the url, of limit urls with maximal time sum by default,
+        over the last days in the store
+
+        Keyword arguments:
+        conn -- connection to the store, see open_store
+        days -- number of days
+        url -- url of the trend
+        limit -- number of urls if url is not given
+        """
+    dates = store_days(conn, days)
+    if not dates:
+        return []
+    if url is None:
+        # +url makes SQLite search the date range by primary key instead of scanning the url index
+        urls = [url for url, in conn.execute(
+            'SELECT url FROM url_stats WHERE date >= ? GROUP BY +url ORDER BY SUM(time_sum) DESC LIMIT ?',
+            (dates[0], limit))]
+    else:
+        urls = [url]
+    rows = []
+    for url in urls:
+        rows.extend({'url': url, 'date': date, 'count': count, 'time_avg': round(time_sum / count, 3),
+                     'time_max': time_max, 'time_med': round(time_med, 3), 'time_p95': round(time_p95, 3)}
+                    for date, count, time_sum, time_max, time_med, time_p95 in conn.execute(
+                        'SELECT date, count, time_sum, time_max, time_med, time_p95 FROM url_stats '
+                        'WHERE url = ? AND date >= ? ORDER BY date', (url, dates[0])))
+    return rows
+
+
+def query_regressions(conn, days, threshold=0.2, min_count=10, limit=20):
+    """Return urls whose median request time of the last day in the store exceeds
+        the average of daily medians of the previous days - 1 days by more than threshold,
+        sorted by extra time of the day
+
+        Keyword arguments:
+        conn -- connection to the store, see open_store
+        days -- number of days including the last one
+        threshold -- relative growth of the median
+        min_count -- minimal number of requests of the url in the last day
+        limit -- number of urls
+        """
+    dates = store_days(conn, days)
+    if len(dates) < 2:
+        return []
+    query = """
+        WITH base AS (
+            SELECT url, AVG(time_med) AS time_med, SUM(time_sum) / SUM(count) AS time_avg, COUNT(*) AS days
+            FROM url_stats WHERE date >= ? AND date < ? GROUP BY +url)
+        SELECT last.url, last.count, last.time_med, base.time_med, last.time_sum / last.count, base.time_avg,
+               base.days
+        FROM url_stats AS last JOIN base ON base.url = last.url
+        WHERE last.date = ? AND last.count >= ? AND last.time_med > base.time_med * ?
+        ORDER BY (last.time_med - base.time_med) * last.count DESC LIMIT ?"""
+    return [{'url': url, 'date': dates[-1], 'count': count, 'time_med': round(time_med, 3),
+             'base_time_med': round(base_med, 3), 'time_avg': round(time_avg, 3),
+             'base_time_avg': round(base_avg, 3), 'base_days': base_days,
+             'growth': round(time_med / base_med - 1, 3) if base_med else None}
+            for url, count, time_med, base_med, time_avg, base_avg, base_days in conn.execute(
+                query, (dates[0], dates[-1], dates[-1], int(min_count), 1 + float(threshold), limit))]
+
+
+def print_rows(rows):
+    """Print rows as tab separated table with header"""
+    if not rows:
+        print('No data')
+        return
+    print('\t'.join(rows[0]))
+    for row in rows:
+        print('\t'.join(str(value) for value in row.values()))
+
+
+def write_atomic(path, write):
+    """Write text file with write(f) into temporary file next to it and rename it to path,
+        so readers never see partially written file"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+            write(f)
+        os.replace(path + '.tmp', path)
+    except BaseException:
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+
+
+def load_template(path):
+    """Return parts of the report template between $table_json placeholders.
+        The template is parsed once and parsed again only when the file is changed.
+        Other placeholders are kept and $$ is unescaped as in Template.safe_substitute"""
+    key = os.path.abspath(path), os.stat(path).st_mtime_ns
+    parts = report_templates.get(key)
+    if parts is None:
+        with open(path, encoding='utf-8') as f:
+            template = f.read()
+        parts, pos = [], 0
+        for m in Template.pattern.finditer(template):
+            if (m.group('named') or m.group('braced')) == TEMPLATE_FIELD:
+                parts.append(template[pos:m.start()])
+                pos = m.end()
+        parts.append(template[pos:])
+        parts = [Template(part).safe_substitute() for part in parts]
+        report_templates.clear()
+        report_templates[key] = parts
+    return parts
+
+
+def write_json_rows(f, rows, separators=(', ', ': '), html=False):
+    """Write list of report rows to file as JSON array, REPORT_BATCH rows at a time
+
+        Keyword arguments:
+        separators -- item and key separators of json encoder
+        html -- escape '</' so that the rows can not close the script element
+        """
+    encode = json.JSONEncoder(separators=separators).encode
+    f.write('[')
+    for start in range(0, len(rows), REPORT_BATCH):
+        if start:
+            f.write(separators[0])
+        batch = encode(rows[start:start + REPORT_BATCH])[1:-1]
+        f.write(batch.replace('</', '<\\/') if html else batch)
+    f.write(']')
+
+
+def write_html_report(f, rows, parts):
+    for i, part in enumerate(parts):
+        if i:
+            write_json_rows(f, rows, html=True)
+        f.write(part)
+
+
+def write_csv_report(f, rows):
+    writer = csv.writer(f)
+    if rows:
+        fields = list(rows[0])
+        writer.writerow(fields)
+        writer.writerows([row.get(field) for field in fields] for row in rows)
+
+
+def report_formats(config):
+    """Return formats of the report: html and extra_formats setting (json, csv)"""
+    extra = [fmt for fmt in re.split(r'[\s,]+', config.get('extra_formats') or '') if fmt]
+    unknown = set(extra) - {'json', 'csv'}
+    if unknown:
+        logging.error(f'Unknown report formats {sorted(unknown)} are skipped')
+    return ['html'] + [fmt for fmt in extra if fmt not in unknown and fmt != 'html']
+
+
 @log('Report generation error')
-def create_report(config, file_date, report_url):
-    """Function generates a report
+def create_report(config, file_date, report_url, report_name=None, formats=None):
+    """Function generates a report. The template is parsed once, rows are
+    streamed with JSON encoder into temporary file which is renamed to the report
 
     Keyword arguments:
     file_path -- named tuple = the result of find_log function
     config -- configuration parameters (dict)
+    report_name -- file name of the report, report-YYYY.MM.DD.html by default
+    formats -- report formats, see report_formats; json and csv files are named as the html report
     """
+    report_size = config.get('report_size')
+    rows = report_url if report_size is None else report_url[:int(report_size)]
+    parts = load_template(config.get('report_template') or 'report.html')
+    report_name = report_name or 'report-' + file_date.strftime('%Y.%m.%d') + '.html'
+    base_path = os.path.join(config.get('report_dir'), os.path.splitext(report_name)[0])
+
+    writers = {'html': lambda f: write_html_report(f, rows, parts),
+               'json': lambda f: write_json_rows(f, rows, separators=(',', ':')),
+               'csv': lambda f: write_csv_report(f, rows)}
+    for fmt in formats or report_formats(config):
+        report_path = base_path + '.' + fmt
+        write_atomic(report_path, writers[fmt])
+        logging.info(f'Report is generated: {report_path}')
 
-    with open('report.html', 'r') as f:
-        template = f.read()
 
-    report_content = Template(template).safe_substitute({'table_json': report_url[:config.get('report_size')]})
+@log('Error with processing log file')
+def process_log(file_path, config, workers=1, rebuild=False):
+    """Generate the report of the log file, the aggregate is loaded from cache
+        when possible. Return summary: file name, date, number of lines, wall time and lines/sec.
+
+        Keyword arguments:
+        file_path -- named tuple = the result of find_log function
+        config -- configuration parameters (dict)
+        workers -- number of processes parsing uncompressed log file
+        rebuild -- reparse the log ignoring the aggregate cache
+        """
+    start = time.monotonic()
+    file_dir = os.path.join(config.get('log_dir'), file_path.file_name)
+    rel_error = get_rel_error(config.get('aggregate_mode'), config.get('quantile_error'))
+    settings = aggregate_settings(config)
+    aggregate = None if rebuild else profile_call('load_aggregate', load_aggregate, config.get('cache_dir'),
+                                                  file_dir, rel_error, settings, file_path.file_name)
+    cached = aggregate is not None
+    if cached:
+        logging.info(f'Aggregate of {file_path.file_name} is loaded from cache')
+    else:
+        aggregate = collect_stat(file_path, config, workers)
+        if aggregate:
+            profile_call('save_aggregate', save_aggregate, config.get('cache_dir'), file_dir, aggregate, rel_error,
+                         settings, file_path.file_name)
+
+    # the store has one log per day, logs of subdirectories (hosts) are not saved
+    if aggregate and aggregate.total_amount and config.get('store_path') and not os.path.dirname(file_path.file_name):
+        # the store gets the day once, reparsed logs replace it
+        profile_call('store_aggregate', store_aggregate, config.get('store_path'), file_path, aggregate, rel_error,
+                     replace=not cached)
+    if aggregate and aggregate.total_amount:
+        report_url = profile_call('build_report_rows', build_report_rows, *aggregate, config.get('report_size'))
+        create_report(config, file_path.date, report_url, report_file_name(file_path))
+    elif aggregate:
+        logging.info('The file is empty. Report not generated')
+
+    wall_time = time.monotonic() - start
+    lines = aggregate.total_amount if aggregate else 0
+    return {'file': file_path.file_name, 'date': file_path.date.strftime('%Y.%m.%d'), 'cached': cached,
+            'lines': lines, 'wall_time': round(wall_time, 3),
+            'lines_per_sec': round(lines / wall_time) if wall_time else 0}
+
+
+def batch_reports(config, max_workers, rebuild=False, force=False):
+    """Generate reports for all logs in log directory without report, max_workers
+        files are processed at a time in separate processes. Return list of summaries of process_log
+
+        Keyword arguments:
+        config -- configuration parameters (dict)
+        max_workers -- number of files processed concurrently
+        rebuild -- reparse all logs ignoring the aggregate cache and overwrite existing reports
+        force -- overwrite existing reports, aggregates are loaded from cache when possible
+        """
+    file_paths = [file_path for file_path in find_logs(config.get('log_dir'), config.get('log_depth'),
+                                                       config.get('log_index')) or []
+                  if rebuild or force or not is_report_exist(file_path.date, config.get('report_dir'),
+                                                    report_file_name(file_path))]
+    if not file_paths:
+        logging.info('No data to process')
+        return []
+
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        futures = [executor.submit(process_log, file_path, config, 1, rebuild) for file_path in file_paths]
+        summaries = [future.result() for future in futures]
+
+    for file_path, summary in zip(file_paths, summaries):
+        if summary:
+            logging.info('{file}: {lines} lines, {wall_time} s, {lines_per_sec} lines/sec'.format(**summary) +
+                         (' (from cache)' if summary['cached'] else ''))
+        else:
+            logging.error(f'{file_path.file_name}: report is not generated')
+    logging.info(f'Batch of {len(file_paths)} files is processed in {time.monotonic() - start:.3f} s')
+    return summaries
+
+
+class LogFollower:
+    """Incremental aggregator of the active log file.
+
+        Reads lines appended since the previous poll, keeps inode and offset
+        of the file, so it continues with the new file after logrotate moves
+        the old one and starts from the beginning after copytruncate.
+        Aggregates are reset on rotation and cover the current log file.
+
+        Keyword arguments:
+        path -- path to the active log file
+        rel_error -- relative error of quantile sketches, None for exact mode
+        url_rules -- url normalization rules, see parse_url_rules
+        max_urls -- max number of tracked urls, see accumulate_stat
+        on_rotate -- function called with the follower when the file is rotated or truncated,
+                     before the aggregate of the previous file is reset
+        """
+
+    def __init__(self, path, rel_error=None, url_rules=None, max_urls=0, on_rotate=None):
+        self.path = path
+        self.rel_error = rel_error
+        self.url_rules = url_rules
+        self.max_urls = int(max_urls or 0)
+        self.on_rotate = on_rotate
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        self.tail = b''
+        self.reset()
+
+    def rotate(self):
+        """Pass the aggregate of the previous file to on_rotate and reset it"""
+        if self.on_rotate and self.total_lines:
+            self.on_rotate(self)
+        self.reset()
+
+    def reset(self):
+        self.url_stats = {}
+        self.tracker = SpaceSaving(self.max_urls, self.rel_error) if self.max_urls else None
+        self.total_amount = self.total_time = 0
+        self.total_lines = self.err_counts = 0
+        self.parse = fast_line_parser(self.url_rules)
+
+    @property
+    def aggregate(self):
+        url_stats = self.tracker.stats() if self.tracker else self.url_stats
+        return Aggregate(url_stats, self.total_amount, self.total_time)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _open(self):
+        self.close()
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.offset = 0
+        self.tail = b''
+        return True
+
+    def _add(self, line):
+        self.total_lines += 1
+        try:
+            url, time_request = self.parse(line)
+        except:
+            self.err_counts += 1
+            return
+        if self.tracker:
+            stat = self.tracker.get(url)
+        else:
+            stat = self.url_stats.get(url)
+            if stat is None:
+                stat = self.url_stats[url] = UrlStat(self.rel_error)
+        stat.add(time_request)
+        self.total_amount += 1
+        self.total_time += time_request
+
+    def _read(self, final=False):
+        lines = 0
+        for chunk in iter(lambda: self.file.read(GZ_CHUNK_SIZE), b''):
+            self.offset += len(chunk)
+            chunk = self.tail + chunk
+            cut = chunk.rfind(b'\n')
+            self.tail = chunk[cut + 1:]
+            if cut != -1:
+                for line in chunk[:cut].split(b'\n'):
+                    self._add(line)
+                    lines += 1
+        if final and self.tail:
+            self._add(self.tail)
+            self.tail = b''
+            lines += 1
+        return lines
+
+    def poll(self):
+        """Read lines appended since the previous poll. Return number of read lines"""
+        if self.file is None:
+            return self._read() if self._open() else 0
+        lines = self._read()
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # the file is rotated, the new one is not created yet
+            return lines
+        if st.st_ino != self.inode:
+            lines += self._read(final=True)
+            logging.info(f'{self.path} is rotated, {self.total_lines} lines of the previous file are processed')
+            self.rotate()
+            if self._open():
+                lines += self._read()
+        elif st.st_size < self.offset:
+            logging.info(f'{self.path} is truncated')
+            self.rotate()
+            self.file.seek(0)
+            self.offset = 0
+            self.tail = b''
+            lines += self._read()
+        return lines
+
+
+def write_snapshot(config, follower, report_url):
+    """Write JSON snapshot of the report rows and counters of the followed log
+
+        Keyword arguments:
+        config -- configuration parameters (dict)
+        follower -- LogFollower
+        report_url -- report rows
+        """
     report_dir = config.get('report_dir')
+    snapshot = {'file': follower.path, 'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+                'total_lines': follower.total_lines, 'err_counts': follower.err_counts,
+                'rows': report_url[:int(config.get('report_size'))]}
+    write_atomic(os.path.join(report_dir, 'report-live.json'), lambda f: json.dump(snapshot, f))
 
-    if not os.path.exists(report_dir):
-        os.makedirs(report_dir)
 
-    report_path = os.path.join(report_dir, 'report-' + file_date.strftime('%Y.%m.%d') + '.html')
+def follow_log(config, path, iterations=None):
+    """Tail the active log file and re-render report-live.html and report-live.json
+        every follow_interval seconds and once more with the rest of the previous file
+        when the log is rotated
 
-    with open(report_path, 'w', encoding='utf-8') as f:
-        f.write(report_content)
-    logging.info(f'Report is generated: {report_path}')
+        Keyword arguments:
+        config -- configuration parameters (dict)
+        path -- path to the active log file
+        iterations -- number of polls, endless by default
+        """
+    def render(follower):
+        nonlocal rendered
+        report_url = build_report_rows(*follower.aggregate, config.get('report_size')) \
+            if follower.total_amount else []
+        write_snapshot(config, follower, report_url)
+        # report-live.json is the snapshot
+        create_report(config, datetime.datetime.now(), report_url, 'report-live.html',
+                      [fmt for fmt in report_formats(config) if fmt != 'json'])
+        rendered = time.monotonic()
+
+    follower = LogFollower(path, get_rel_error(config.get('aggregate_mode'), config.get('quantile_error')),
+                           parse_url_rules(config.get('url_rules')), config.get('max_urls'), render)
+    interval, poll = float(config.get('follow_interval')), float(config.get('follow_poll'))
+    logging.info(f'Following {path}')
+    rendered = time.monotonic()
+    changed = True
+    try:
+        while iterations is None or iterations > 0:
+            changed = follower.poll() > 0 or changed
+            if changed and (time.monotonic() - rendered >= interval or iterations == 1):
+                render(follower)
+                changed = False
+            if iterations is not None:
+                iterations -= 1
+            if iterations != 0:
+                time.sleep(poll)
+    finally:
+        follower.close()
+    return follower
 
 
 def main():
@@ -240,18 +1908,43 @@ def main():
         level=log_levels.get(args.level)
     )
 
-    file_path = find_log(cfg.get("log_dir"))
-    if file_path:
-        report_exist = is_report_exist(file_path.date, cfg.get('report_dir'))
-    if report_exist:
-        logging.info(f'Report on date {file_path.date.strftime("%Y.%m.%d")} already exists')
-        sys.exit()
-
-    if file_path:
-        log = parser_log(file_path, cfg.get('log_dir'), cfg.get('err_lines'))
-        report_url = aggregate_stat(file_path, log)
-        if report_url:
-            create_report(config, file_path.date, report_url)
+    global profiler
+    if args.profile:
+        profiler = Profiler(cprofile=not args.profile.endswith('.json'))
+    try:
+        if args.query:
+            conn = open_store(cfg.get('store_path'))
+            try:
+                if args.query == 'trend':
+                    rows = query_trend(conn, args.days, args.url, args.limit)
+                else:
+                    rows = query_regressions(conn, args.days, cfg.get('regression_threshold'),
+                                             cfg.get('regression_min_count'), args.limit)
+            finally:
+                conn.close()
+            print_rows(rows)
+            return
+
+        if args.follow is not None:
+            follow_log(cfg, args.follow or cfg.get('follow_file'))
+            return
+
+        if args.batch:
+            batch_reports(cfg, int(cfg.get('batch_workers')), args.rebuild, args.force)
+            return
+
+        file_path = find_log(cfg.get("log_dir"), cfg.get('log_depth'), cfg.get('log_index'))
+        if not file_path:
+            return
+        if not (args.rebuild or args.force) and \
+                is_report_exist(file_path.date, cfg.get('report_dir'), report_file_name(file_path)):
+            logging.info(f'Report on date {file_path.date.strftime("%Y.%m.%d")} already exists')
+            sys.exit()
+
+        process_log(file_path, cfg, args.workers, args.rebuild)
+    finally:
+        if profiler is not None:
+            profiler.dump(args.profile)
 
 
 if __name__ == "__main__":
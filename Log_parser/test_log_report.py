@@ -1,10 +1,43 @@
 import unittest
+import unittest.mock
+import shutil
 import os
+import random
+import tempfile
+import gzip
+import struct
+import zlib
 from collections import namedtuple
 import datetime
 import logging
 from log_analyzer import *
 
+LOG_LINE = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" '
+            '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+            '"dc7161be3" {time:.3f}\n')
+
+
+def write_log(log_dir, file_name='nginx-access-ui-20170820.log', lines=1000, urls=50, bad_lines=3, seed=1):
+    rnd = random.Random(seed)
+    content = [LOG_LINE.format(url=f'/api/v2/banner/{rnd.randrange(urls)}', time=rnd.randrange(1, 5000) / 1000)
+               for _ in range(lines)]
+    for i in range(bad_lines):
+        content.insert(rnd.randrange(len(content)), 'broken line\n')
+    with open(os.path.join(log_dir, file_name), 'w', encoding='utf-8') as f:
+        f.writelines(content)
+    return FilePath(file_name, datetime.datetime.strptime(file_name[-12:-4], '%Y%m%d'), 'log')
+
+
+def write_bgzf(file_dir, data, block_size=4096):
+    with open(file_dir, 'wb') as f:
+        for i in range(0, len(data), block_size):
+            block = data[i:i + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            body = compressor.compress(block) + compressor.flush()
+            f.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' +
+                    struct.pack('<H2sHH', 6, b'BC', 2, 12 + 6 + len(body) + 8 - 1) + body +
+                    struct.pack('<II', zlib.crc32(block), len(block)))
+
 
 class TestFindLog(unittest.TestCase):
 
@@ -29,7 +62,13 @@ class TestFindLog(unittest.TestCase):
 
     def test_build_config(self):
         config = {'log_dir': './log', 'log_file': './report.log', 'report_dir': './reports',
-                  'report_size': 1000, 'err_lines': '20'}
+                  'report_size': 1000, 'err_lines': '20', 'aggregate_mode': 'exact', 'quantile_error': '0.01',
+                  'gz_reader': 'gzip', 'gz_threads': '2', 'line_parser': 'fast', 'cache_dir': './reports/.cache',
+                  'follow_file': './log/nginx-access-ui.log', 'follow_interval': '60', 'follow_poll': '1',
+                  'batch_workers': '4', 'url_rules': '', 'max_urls': '0',
+                  'backend': 'auto', 'report_template': './report.html', 'extra_formats': '',
+                  'store_path': './reports/stats.sqlite', 'regression_threshold': '0.2',
+                  'regression_min_count': '10', 'log_depth': '0', 'log_index': './reports/.cache/logs.idx'}
         self.assertEqual(build_config(), config)
 
     def test_aggregate_stat(self):
@@ -50,6 +89,668 @@ class TestFindLog(unittest.TestCase):
             os.path.join(config.get('report_dir'), 'report-' + file_date.strftime("%Y.%m.%d") + '.html')))
 
 
+class TestAggregateStat(unittest.TestCase):
+
+    def setUp(self):
+        self.log = [['/api/1', t / 1000] for t in range(1, 2001)] + [['/api/2', 0.5], ['/api/2', 0.0], ['/api/2', 0.3]]
+        self.file_path = FilePath('nginx-access-ui-20170820.log', datetime.datetime(2017, 8, 20), 'log')
+
+    def test_sketch_matches_exact_totals(self):
+        exact = aggregate_stat(self.file_path, iter(self.log), 'exact')
+        sketch = aggregate_stat(self.file_path, iter(self.log), 'sketch', 0.01)
+        self.assertEqual([r['url'] for r in exact], [r['url'] for r in sketch])
+        for e, s in zip(exact, sketch):
+            for key in ('count', 'count_perc', 'time_max', 'time_perc', 'time_sum'):
+                self.assertEqual(e[key], s[key])
+            self.assertAlmostEqual(e['time_med'], s['time_med'], delta=e['time_med'] * 0.01 + 0.001)
+        self.assertAlmostEqual(sketch[0]['time_p99'], 1.98, delta=1.98 * 0.01 + 0.001)
+
+    def test_top_rows(self):
+        aggregate = accumulate_stat([['/a', 1.0], ['/b', 2.0], ['/c', 0.5], ['/d', 2.0], ['/a', 1.0], ['/e', 0.1]])
+        rows = build_report_rows(*aggregate)
+        self.assertEqual([r['url'] for r in rows], ['/a', '/b', '/d', '/c', '/e'])
+        for size in (0, 2, 3, 10):
+            self.assertEqual(build_report_rows(*aggregate, size), rows[:size])
+
+    def test_sketch_merge(self):
+        first, second = UrlStat(0.01), UrlStat(0.01)
+        for i, (_, t) in enumerate(self.log[:2000]):
+            (first if i % 2 else second).add(t)
+        first.merge(second)
+        self.assertEqual(first.count, 2000)
+        self.assertEqual(first.time_max, 2.0)
+        self.assertAlmostEqual(first.quantile(0.5), 1.0, delta=0.011)
+        self.assertLess(len(first.sketch.bins), 400)
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = write_log(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_split_file(self):
+        file_dir = os.path.join(self.tmp.name, self.file_path.file_name)
+        ranges = split_file(file_dir, 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(file_dir))
+        with open(file_dir, 'rb') as f:
+            data = f.read()
+        for start, end in ranges:
+            self.assertTrue(start == 0 or data[start - 1:start] == b'\n')
+
+    def test_split_tiny_file(self):
+        file_dir = os.path.join(self.tmp.name, 'tiny.log')
+        with open(file_dir, 'wb') as f:
+            f.write(b'a\n')
+        self.assertEqual([(0, 2)], split_file(file_dir, 4))
+        open(file_dir, 'wb').close()
+        self.assertEqual([], split_file(file_dir, 4))
+
+    def test_parallel_matches_serial(self):
+        serial = aggregate_stat(self.file_path, parser_log(self.file_path, self.tmp.name, 20))
+        parallel = aggregate_parallel(self.file_path, self.tmp.name, 20, 3)
+        self.assertEqual(serial, parallel)
+
+    def test_parallel_error_rate(self):
+        file_path = write_log(self.tmp.name, lines=10, bad_lines=5)
+        self.assertIsNone(aggregate_parallel(file_path, self.tmp.name, 20, 3))
+
+
+class TestGzipReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = write_log(self.tmp.name)
+        with open(os.path.join(self.tmp.name, self.file_path.file_name), 'rb') as f:
+            self.data = f.read()
+        self.expected = aggregate_stat(self.file_path, parser_log(self.file_path, self.tmp.name, 20))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_gz(self, file_name, threads):
+        file_path = FilePath(file_name, self.file_path.date, 'gz')
+        for reader in ('gzip', 'threaded'):
+            log = parser_log(file_path, self.tmp.name, 20, reader, threads)
+            self.assertEqual(aggregate_stat(file_path, log), self.expected, reader)
+
+    def test_single_member(self):
+        with gzip.open(os.path.join(self.tmp.name, 'log.gz'), 'wb') as f:
+            f.write(self.data)
+        self.check_gz('log.gz', 1)
+
+    def test_multi_member(self):
+        half = self.data.index(b'\n', len(self.data) // 2) + 1
+        with open(os.path.join(self.tmp.name, 'log.gz'), 'wb') as f:
+            f.write(gzip.compress(self.data[:half]) + gzip.compress(self.data[half:]))
+        self.check_gz('log.gz', 1)
+
+    def test_bgzf(self):
+        file_dir = os.path.join(self.tmp.name, 'log.gz')
+        write_bgzf(file_dir, self.data)
+        self.assertTrue(is_bgzf(file_dir))
+        self.check_gz('log.gz', 3)
+
+    def test_truncated(self):
+        file_dir = os.path.join(self.tmp.name, 'log.gz')
+        with open(file_dir, 'wb') as f:
+            f.write(gzip.compress(self.data)[:-100])
+        with self.assertRaises(EOFError):
+            b''.join(read_gz_chunks(file_dir))
+
+
+class TestFastParser(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = write_log(self.tmp.name, bad_lines=0)
+        with open(os.path.join(self.tmp.name, self.file_path.file_name), 'a', encoding='utf-8') as f:
+            f.write('  \t' + LOG_LINE.format(url='/leading/space', time=0.5).replace(' ', '\t', 3))
+            f.write('1 2 3 4 5 6 /api/7/fields 0.25\r\n')
+            f.write('1 2 3 4 5 6 /api/no/time -\n')
+            f.write('1 2 3 4 5 6\n\n')
+            f.write(LOG_LINE.format(url='/api/юникод', time=1.0).rstrip('\n'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_fast_matches_split(self):
+        split = list(parser_log(self.file_path, self.tmp.name, 50, line_parser='split'))
+        fast = list(parser_log(self.file_path, self.tmp.name, 50, line_parser='fast'))
+        self.assertEqual(len(split), 1003)
+        self.assertEqual(split, fast)
+
+    def test_fast_gz_and_parallel(self):
+        file_dir = os.path.join(self.tmp.name, self.file_path.file_name)
+        with open(file_dir, 'rb') as src, gzip.open(file_dir + '.gz', 'wb') as dst:
+            dst.write(src.read())
+        gz_path = FilePath(self.file_path.file_name + '.gz', self.file_path.date, 'gz')
+        expected = aggregate_stat(self.file_path, parser_log(self.file_path, self.tmp.name, 50))
+        for reader in ('gzip', 'threaded'):
+            log = parser_log(gz_path, self.tmp.name, 50, reader, 1, 'fast')
+            self.assertEqual(aggregate_stat(gz_path, log), expected)
+        self.assertEqual(aggregate_parallel(self.file_path, self.tmp.name, 50, 3, line_parser='fast'), expected)
+
+
+class TestPlainReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = write_log(self.tmp.name)
+        self.file_dir = os.path.join(self.tmp.name, self.file_path.file_name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ranges_match_file(self):
+        lines = list(iter_plain_lines(self.file_dir))
+        self.assertEqual([line for start, end in split_file(self.file_dir, 3)
+                          for line in iter_plain_lines(self.file_dir, start, end)], lines)
+        expected = aggregate_stat(self.file_path, parser_log(self.file_path, self.tmp.name, 20))
+        log = parser_log(self.file_path, self.tmp.name, 20, line_parser='fast')
+        self.assertEqual(aggregate_stat(self.file_path, log), expected)
+        self.assertEqual(aggregate_parallel(self.file_path, self.tmp.name, 20, 2, line_parser='fast'), expected)
+
+    def test_empty_file(self):
+        open(self.file_dir, 'w').close()
+        self.assertEqual(list(iter_plain_lines(self.file_dir)), [])
+        self.assertIsNone(aggregate_stat(self.file_path, parser_log(self.file_path, self.tmp.name, 20,
+                                                                    line_parser='fast')))
+
+
+class TestAggregateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = write_log(self.tmp.name)
+        self.file_dir = os.path.join(self.tmp.name, self.file_path.file_name)
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        for rel_error in (None, 0.01):
+            aggregate = accumulate_stat(parser_log(self.file_path, self.tmp.name, 20), rel_error)
+            save_aggregate(self.cache_dir, self.file_dir, aggregate, rel_error)
+            cached = load_aggregate(self.cache_dir, self.file_dir, rel_error)
+            self.assertEqual(cached.total_amount, aggregate.total_amount)
+            self.assertEqual(build_report_rows(*cached), build_report_rows(*aggregate))
+
+    def test_stale_cache(self):
+        aggregate = accumulate_stat(parser_log(self.file_path, self.tmp.name, 20))
+        save_aggregate(self.cache_dir, self.file_dir, aggregate)
+        self.assertIsNone(load_aggregate(self.cache_dir, self.file_dir, 0.01))
+        with open(self.file_dir, 'a') as f:
+            f.write(LOG_LINE.format(url='/api/new', time=1))
+        self.assertIsNone(load_aggregate(self.cache_dir, self.file_dir))
+        self.assertIsNone(load_aggregate(self.tmp.name, self.file_dir))
+
+    def test_force_regenerates_from_cache(self):
+        template = os.path.join(self.tmp.name, 'report.html')
+        with open(template, 'w') as f:
+            f.write('<script>var table = $table_json;</script>')
+        config = {'log_dir': self.tmp.name, 'report_dir': os.path.join(self.tmp.name, 'reports'),
+                  'cache_dir': self.cache_dir, 'report_template': template, 'report_size': 10, 'err_lines': 20,
+                  'aggregate_mode': 'exact', 'line_parser': 'fast'}
+        report = os.path.join(config['report_dir'], 'report-2017.08.20.html')
+        self.assertFalse(batch_reports(config, 1)[0]['cached'])
+        self.assertTrue(os.path.exists(report))
+        self.assertEqual(batch_reports(config, 1), [])
+        config['report_size'] = 3
+        with unittest.mock.patch('log_analyzer.collect_stat', side_effect=AssertionError('the log is reparsed')):
+            summary = process_log(self.file_path, config)
+        self.assertTrue(summary['cached'])
+        with open(report) as f:
+            self.assertEqual(f.read().count('"url"'), 3)
+        summaries = batch_reports(config, 1, force=True)
+        self.assertEqual([True], [s['cached'] for s in summaries])
+
+
+class TestFollow(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'nginx-access-ui.log')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def append(self, path, text):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_incremental(self):
+        follower = LogFollower(self.path)
+        self.assertEqual(follower.poll(), 0)
+        self.append(self.path, LOG_LINE.format(url='/a', time=1) + LOG_LINE.format(url='/b', time=2)[:40])
+        self.assertEqual(follower.poll(), 1)
+        self.append(self.path, LOG_LINE.format(url='/b', time=2)[40:] + 'broken\n')
+        self.assertEqual(follower.poll(), 2)
+        self.assertEqual(follower.total_amount, 2)
+        self.assertEqual(follower.err_counts, 1)
+        self.assertEqual(set(follower.url_stats), {'/a', '/b'})
+        follower.close()
+
+    def test_rotation_and_truncation(self):
+        follower = LogFollower(self.path, 0.01)
+        self.append(self.path, LOG_LINE.format(url='/a', time=1) * 3)
+        follower.poll()
+        self.append(self.path, LOG_LINE.format(url='/a', time=1))
+        os.rename(self.path, self.path + '.1')
+        self.append(self.path, LOG_LINE.format(url='/new', time=1))
+        follower.poll()
+        self.assertEqual(follower.total_amount, 1)
+        self.assertEqual(list(follower.url_stats), ['/new'])
+        self.append(self.path, LOG_LINE.format(url='/new', time=1) * 2)
+        follower.poll()
+        open(self.path, 'w').close()
+        self.append(self.path, LOG_LINE.format(url='/t', time=1))
+        follower.poll()
+        self.assertEqual(list(follower.url_stats), ['/t'])
+        follower.close()
+
+    def test_follow_log_snapshot(self):
+        self.append(self.path, LOG_LINE.format(url='/a', time=1))
+        config = {'report_dir': self.tmp.name, 'report_size': 10, 'aggregate_mode': 'exact',
+                  'follow_interval': 0, 'follow_poll': 0}
+        follow_log(config, self.path, iterations=2)
+        with open(os.path.join(self.tmp.name, 'report-live.json')) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['total_lines'], 1)
+        self.assertEqual(snapshot['rows'][0]['url'], '/a')
+
+    def test_follow_log_renders_rotated_file(self):
+        snapshot_path = os.path.join(self.tmp.name, 'report-live.json')
+        snapshots = []
+
+        def sleep(seconds):
+            if not snapshots:
+                # written after the last poll of the old file, the last line is not terminated
+                self.append(self.path, LOG_LINE.format(url='/b', time=1) + LOG_LINE.format(url='/c', time=1)[:-1])
+                os.rename(self.path, self.path + '.1')
+                self.append(self.path, LOG_LINE.format(url='/new', time=1))
+                snapshots.append(None)
+            else:
+                with open(snapshot_path) as f, open(os.path.join(self.tmp.name, 'report-live.html')) as html:
+                    snapshots.append((json.load(f), html.read()))
+
+        self.append(self.path, LOG_LINE.format(url='/a', time=1))
+        template = os.path.join(self.tmp.name, 'report.html')
+        with open(template, 'w') as f:
+            f.write('<script>var table = $table_json;</script>')
+        config = {'report_dir': self.tmp.name, 'report_size': 10, 'aggregate_mode': 'exact',
+                  'follow_interval': 3600, 'follow_poll': 0, 'report_template': template}
+        with unittest.mock.patch('time.sleep', side_effect=sleep):
+            follow_log(config, self.path, iterations=3)
+        rotated, html = snapshots[1]
+        self.assertEqual(rotated['total_lines'], 3)
+        self.assertEqual({row['url'] for row in rotated['rows']}, {'/a', '/b', '/c'})
+        self.assertIn('"/c"', html)
+        with open(os.path.join(self.tmp.name, 'report-live.html')) as f:
+            self.assertIn('"/new"', f.read())
+        with open(snapshot_path) as f:
+            self.assertEqual([row['url'] for row in json.load(f)['rows']], ['/new'])
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        template = os.path.join(self.tmp.name, 'report.html')
+        with open(template, 'w') as f:
+            f.write('<script>var table = $table_json;</script>')
+        self.config = {'log_dir': self.tmp.name, 'report_dir': os.path.join(self.tmp.name, 'reports'),
+                       'cache_dir': os.path.join(self.tmp.name, 'cache'), 'report_template': template,
+                       'report_size': 10, 'err_lines': 20,
+                       'aggregate_mode': 'exact', 'line_parser': 'fast'}
+        for day in ('20170818', '20170819', '20170820'):
+            write_log(self.tmp.name, f'nginx-access-ui-{day}.log', lines=100)
+        open(os.path.join(self.tmp.name, 'nginx-access-ui-20179999.log'), 'w').close()
+        os.makedirs(self.config['report_dir'])
+        open(os.path.join(self.config['report_dir'], 'report-2017.08.19.html'), 'w').close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_find_logs(self):
+        self.assertEqual([f.file_name for f in find_logs(self.tmp.name)],
+                         ['nginx-access-ui-20170818.log', 'nginx-access-ui-20170819.log',
+                          'nginx-access-ui-20170820.log'])
+        self.assertEqual(find_log(self.tmp.name).file_name, 'nginx-access-ui-20170820.log')
+
+    def test_batch_unreported(self):
+        summaries = batch_reports(self.config, 2)
+        self.assertEqual([s['date'] for s in summaries], ['2017.08.18', '2017.08.20'])
+        self.assertTrue(all(s['lines'] == 100 and not s['cached'] for s in summaries))
+        for day in ('2017.08.18', '2017.08.20'):
+            self.assertTrue(os.path.exists(os.path.join(self.config['report_dir'], f'report-{day}.html')))
+        # reported logs are skipped
+        self.assertEqual(batch_reports(self.config, 2), [])
+        # the log of the hand-made report was never parsed
+        self.assertEqual([(s['date'], s['cached']) for s in batch_reports(self.config, 2, force=True)],
+                         [('2017.08.18', True), ('2017.08.19', False), ('2017.08.20', True)])
+        summaries = batch_reports(self.config, 2, rebuild=True)
+        self.assertEqual(len(summaries), 3)
+        self.assertFalse(any(s['cached'] for s in summaries))
+
+
+    def test_hosts_cache(self):
+        for host, lines in (('host1', 50), ('host2', 70)):
+            os.makedirs(os.path.join(self.tmp.name, host))
+            write_log(os.path.join(self.tmp.name, host), lines=lines, seed=lines)
+        self.config['log_depth'] = 1
+        summaries = batch_reports(self.config, 2)
+        hosts = [s for s in summaries if os.path.dirname(s['file'])]
+        self.assertEqual([(s['file'], s['lines']) for s in hosts],
+                         [('host1/nginx-access-ui-20170820.log', 50), ('host2/nginx-access-ui-20170820.log', 70)])
+        self.assertEqual(sorted(f for f in os.listdir(self.config['cache_dir']) if f.startswith('host')),
+                         ['host1-nginx-access-ui-20170820.log.agg', 'host2-nginx-access-ui-20170820.log.agg'])
+        hosts = [s for s in batch_reports(self.config, 2, force=True) if os.path.dirname(s['file'])]
+        self.assertEqual([(s['lines'], s['cached']) for s in hosts], [(50, True), (70, True)])
+
+
+class TestLogScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_dir = os.path.join(self.tmp.name, 'log')
+        self.index_path = os.path.join(self.tmp.name, 'logs.idx')
+        self.mtime = time.time() - 1000
+        for name in ('nginx-access-ui-20170818.log', 'host1/nginx-access-ui-20170819.gz',
+                     'host2/nginx-access-ui.log-20170820.gz', 'host2/nginx-access-ui-20171340.log', 'host2/other.log'):
+            self.touch(name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def touch(self, name):
+        path = os.path.join(self.log_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        self.age()
+
+    def age(self):
+        # changed directories get distinct mtime out of the racy window of the index
+        for path in (self.log_dir, os.path.join(self.log_dir, 'host1'), os.path.join(self.log_dir, 'host2')):
+            if os.path.exists(path) and os.stat(path).st_mtime > time.time() - 10:
+                self.mtime += 1
+                os.utime(path, (self.mtime, self.mtime))
+
+    def test_depth(self):
+        self.assertEqual([f.file_name for f in find_logs(self.log_dir)], ['nginx-access-ui-20170818.log'])
+        file_paths = find_logs(self.log_dir, 1)
+        self.assertEqual(file_paths, [
+            FilePath('nginx-access-ui-20170818.log', datetime.datetime(2017, 8, 18), 'log'),
+            FilePath(os.path.join('host1', 'nginx-access-ui-20170819.gz'), datetime.datetime(2017, 8, 19), 'gz'),
+            FilePath(os.path.join('host2', 'nginx-access-ui.log-20170820.gz'), datetime.datetime(2017, 8, 20), 'gz')])
+        self.assertEqual([report_file_name(f) for f in file_paths],
+                         ['report-2017.08.18.html', 'report-host1-2017.08.19.html', 'report-host2-2017.08.20.html'])
+        self.assertEqual(find_logs(os.path.join(self.tmp.name, 'absent'), 1), [])
+
+    def test_index(self):
+        expected = find_logs(self.log_dir, 1, self.index_path)
+        with unittest.mock.patch('log_analyzer.scan_dir', wraps=scan_dir) as scan:
+            self.assertEqual(find_logs(self.log_dir, 1, self.index_path), expected)
+            self.assertEqual(scan.call_count, 0)
+
+            self.touch('host1/nginx-access-ui-20170821.log')
+            file_paths = find_logs(self.log_dir, 1, self.index_path)
+            self.assertEqual([call[0][0] for call in scan.call_args_list], [os.path.join(self.log_dir, 'host1')])
+            self.assertEqual(file_paths[-1].file_name, os.path.join('host1', 'nginx-access-ui-20170821.log'))
+
+        shutil.rmtree(os.path.join(self.log_dir, 'host2'))
+        self.age()
+        self.assertEqual(len(find_logs(self.log_dir, 1, self.index_path)), 3)
+        self.assertEqual(sorted(load_log_index(self.index_path)),
+                         [os.path.abspath(self.log_dir), os.path.abspath(os.path.join(self.log_dir, 'host1'))])
+
+
+class TestUrlCardinality(unittest.TestCase):
+
+    def test_normalization(self):
+        rules = parse_url_rules('\n\\?.*$ =>\n/\\d+(?=/|$) => /{id}')
+        self.assertEqual(rules, [('\\?.*$', ''), ('/\\d+(?=/|$)', '/{id}')])
+        normalize = url_normalizer(rules)
+        self.assertEqual(normalize('/api/v2/banner/25019354'), '/api/v2/banner/{id}')
+        self.assertEqual(normalize('/api/1/banners/?campaign=7789704'), '/api/{id}/banners/')
+        self.assertIsNone(url_normalizer([]))
+        line = LOG_LINE.format(url='/api/v2/banner/25019354?x=1', time=0.5)
+        self.assertEqual(fast_line_parser(rules)(line.encode()), ['/api/v2/banner/{id}', 0.5])
+
+    def test_parser_log_normalization(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = write_log(tmp, bad_lines=0)
+            rules = [('/\\d+$', '/{id}')]
+            for line_parser in ('split', 'fast'):
+                urls = {url for url, _ in parser_log(file_path, tmp, 20, line_parser=line_parser, url_rules=rules)}
+                self.assertEqual(urls, {'/api/v2/banner/{id}'})
+
+    def test_space_saving(self):
+        rnd = random.Random(2)
+        log = [['/heavy/%d' % (i % 3), 1.0] if i % 2 else ['/tail/%d' % rnd.randrange(10 ** 6), 0.5]
+               for i in range(10000)]
+        aggregate = accumulate_stat(log, max_urls=10)
+        self.assertLessEqual(len(aggregate.url_stats), 11)
+        self.assertEqual(sum(stat.count for stat in aggregate.url_stats.values()), 10000)
+        self.assertEqual(aggregate.url_stats[OTHER_URL].count + sum(
+            stat.count for url, stat in aggregate.url_stats.items() if url.startswith('/tail')), 5000)
+        for i in range(3):
+            self.assertGreater(aggregate.url_stats['/heavy/%d' % i].count, 1600)
+
+    def test_cap_merged_stats(self):
+        aggregate = accumulate_stat([['/a', 1.0]] * 5 + [['/b', 1.0]] * 3 + [['/c', 1.0], ['/d', 2.0]])
+        capped = cap_url_stats(aggregate.url_stats, 2)
+        self.assertEqual(list(capped), ['/a', '/b', OTHER_URL])
+        self.assertEqual((capped[OTHER_URL].count, capped[OTHER_URL].time_sum), (2, 3.0))
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class TestNumpyBackend(unittest.TestCase):
+
+    def test_matches_python_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = write_log(tmp, lines=5000, urls=300)
+            expected = accumulate_stat(parser_log(file_path, tmp, 20, line_parser='fast'))
+            aggregate = accumulate_stat(parser_log(file_path, tmp, 20, line_parser='fast'), backend='numpy')
+            self.assertEqual(aggregate.total_amount, expected.total_amount)
+            self.assertEqual(aggregate.total_time, expected.total_time)
+            self.assertEqual(build_report_rows(*aggregate), build_report_rows(*expected))
+            self.assertEqual(aggregate_parallel(file_path, tmp, 20, 2, backend='auto'), build_report_rows(*expected))
+
+    def test_even_counts_and_empty_log(self):
+        log = [['/a', 0.1], ['/b', 3.0], ['/a', 0.4], ['/a', 0.2], ['/a', 0.9], ['/b', 1.0]]
+        self.assertEqual(build_report_rows(*accumulate_stat(log, backend='numpy')),
+                         build_report_rows(*accumulate_stat(log)))
+        self.assertEqual(accumulate_stat([], backend='numpy').total_amount, 0)
+        self.assertFalse(use_numpy('numpy', rel_error=0.01))
+        self.assertFalse(use_numpy('auto', max_urls=10))
+
+
+class TestReportWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.template = os.path.join(self.tmp.name, 'report.html')
+        with open(self.template, 'w', encoding='utf-8') as f:
+            f.write('<script>var table = $table_json; var copy = ${table_json};</script> $$5 $other')
+        self.config = {'report_dir': os.path.join(self.tmp.name, 'reports'), 'report_size': 2,
+                       'report_template': self.template, 'extra_formats': 'json, csv'}
+        self.rows = [{'url': '/api/</script>', 'count': 2, 'time_sum': 1.5},
+                     {'url': '/api/\u0434\u0430', 'count': 1, 'time_sum': 0.25},
+                     {'url': '/skipped', 'count': 1, 'time_sum': 0.1}]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_formats(self):
+        create_report(self.config, datetime.datetime(2017, 8, 20), self.rows)
+        path = os.path.join(self.config['report_dir'], 'report-2017.08.20')
+        self.assertEqual(sorted(os.listdir(self.config['report_dir'])),
+                         ['report-2017.08.20.csv', 'report-2017.08.20.html', 'report-2017.08.20.json'])
+        with open(path + '.html', encoding='utf-8') as f:
+            html = f.read()
+        table = json.dumps(self.rows[:2]).replace('</', '<\\/')
+        self.assertEqual(html, f'<script>var table = {table}; var copy = {table};</script> $5 $other')
+        with open(path + '.json', encoding='utf-8') as f:
+            self.assertEqual(json.load(f), self.rows[:2])
+        with open(path + '.csv', encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['url,count,time_sum', '/api/</script>,2,1.5',
+                                                     '/api/\u0434\u0430,1,0.25'])
+
+    def test_atomic_write(self):
+        path = os.path.join(self.tmp.name, 'report.json')
+        write_atomic(path, lambda f: f.write('old'))
+
+        def broken(f):
+            f.write('partial')
+            raise ValueError('broken row')
+
+        with self.assertRaises(ValueError):
+            write_atomic(path, broken)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['report.html', 'report.json'])
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.tmp.name, 'stats.sqlite')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def store_day(self, day, slow=1.0, replace=True, rel_error=None):
+        log = [['/fast', 0.1 * (i % 3 + 1)] for i in range(30)] + [['/slow', slow * (i % 5 + 1)] for i in range(20)]
+        file_path = FilePath(f'nginx-access-ui-201708{day:02d}.log', datetime.datetime(2017, 8, day), 'log')
+        store_aggregate(self.store_path, file_path, accumulate_stat(log, rel_error), rel_error, replace)
+
+    def test_trend_and_regressions(self):
+        for day in range(1, 6):
+            self.store_day(day)
+        self.store_day(6, slow=2.0)
+        conn = open_store(self.store_path)
+        try:
+            trend = query_trend(conn, 3)
+            self.assertEqual([(row['url'], row['date']) for row in trend],
+                             [('/slow', '2017-08-04'), ('/slow', '2017-08-05'), ('/slow', '2017-08-06'),
+                              ('/fast', '2017-08-04'), ('/fast', '2017-08-05'), ('/fast', '2017-08-06')])
+            self.assertEqual(trend[2], {'url': '/slow', 'date': '2017-08-06', 'count': 20, 'time_avg': 6.0,
+                                        'time_max': 10.0, 'time_med': 6.0, 'time_p95': 10.0})
+            self.assertEqual(len(query_trend(conn, 30, '/fast')), 6)
+
+            regressions = query_regressions(conn, 7, threshold=0.2, min_count=10)
+            self.assertEqual(len(regressions), 1)
+            self.assertEqual((regressions[0]['url'], regressions[0]['base_days'], regressions[0]['growth']),
+                             ('/slow', 5, 1.0))
+            self.assertEqual(query_regressions(conn, 7, min_count=50), [])
+            self.assertEqual(query_regressions(conn, 1), [])
+        finally:
+            conn.close()
+
+    def test_replace_day(self):
+        self.store_day(1)
+        self.store_day(1, slow=2.0, replace=False)
+        self.store_day(2, rel_error=0.01)
+        conn = open_store(self.store_path)
+        try:
+            self.assertEqual(conn.execute("SELECT time_max FROM url_stats WHERE url = '/slow' ORDER BY date").fetchall(),
+                             [(5.0,), (5.0,)])
+            sketch = conn.execute("SELECT sketch FROM url_stats WHERE date = '2017-08-02' AND url = '/fast'").fetchone()[0]
+            self.assertEqual(QuantileSketch.load(marshal.loads(sketch), 0.01).count, 30)
+        finally:
+            conn.close()
+        self.store_day(1, slow=2.0)
+        conn = open_store(self.store_path)
+        try:
+            self.assertEqual(conn.execute("SELECT time_max FROM url_stats WHERE url = '/slow' ORDER BY date").fetchall(),
+                             [(10.0,), (5.0,)])
+        finally:
+            conn.close()
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_nested_stages(self):
+        def slow(items):
+            for i in range(items):
+                time.sleep(0.01)
+                yield b'x' * i
+
+        def consume(items):
+            time.sleep(0.02)
+            return sum(1 for _ in items)
+
+        profiler = Profiler(calibrate=False)
+        self.assertEqual(profiler.call('consume', consume, profiler.iterate('slow', slow(5), len)), 5)
+        stages = profiler.report()['stages']
+        self.assertEqual((stages['slow']['items'], stages['slow']['bytes'], stages['slow']['calls']), (5, 10, 1))
+        self.assertGreaterEqual(stages['slow']['wall_time'], 0.05)
+        self.assertGreaterEqual(stages['consume']['wall_time'], 0.02)
+        self.assertLess(stages['consume']['wall_time'], 0.045)
+        self.assertLess(stages['slow']['cpu_time'], 0.04)
+
+    def test_generator_stages_and_dump(self):
+        import log_analyzer
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = write_log(tmp)
+            log_analyzer.profiler = Profiler(cprofile=True)
+            try:
+                log = list(parser_log(file_path, tmp, 20, line_parser='fast'))
+                log_analyzer.profiler.dump(os.path.join(tmp, 'profile.prof'))
+            finally:
+                log_analyzer.profiler = None
+            with open(os.path.join(tmp, 'profile.json')) as f:
+                stages = json.load(f)['stages']
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'profile.prof')))
+            self.assertEqual(stages['parser_log']['items'], len(log))
+            self.assertEqual(stages['read']['items'], 1003)
+            self.assertEqual(stages['read']['bytes'], os.path.getsize(os.path.join(tmp, file_path.file_name)))
+
+    def test_text_reader_counts_bytes(self):
+        import log_analyzer
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = write_log(tmp, lines=10, bad_lines=0)
+            with open(os.path.join(tmp, file_path.file_name), 'a', encoding='utf-8') as f:
+                f.write(LOG_LINE.format(url='/поиск/ünïcode', time=1))
+            size = os.path.getsize(os.path.join(tmp, file_path.file_name))
+            for line_parser in ('split', 'fast'):
+                log_analyzer.profiler = Profiler()
+                try:
+                    list(parser_log(file_path, tmp, 20, line_parser=line_parser))
+                    stages = log_analyzer.profiler.report()['stages']
+                finally:
+                    log_analyzer.profiler = None
+                self.assertEqual(stages['read']['bytes'], size)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_generate_log(self):
+        import benchmark
+        with tempfile.TemporaryDirectory() as tmp:
+            plain = os.path.join(tmp, 'nginx-access-ui-20170630.log')
+            self.assertEqual(benchmark.generate_log(plain, 3000, urls=100, skew=1.2, bad_ratio=0.01), 3000)
+            benchmark.generate_log(os.path.join(tmp, 'copy.log'), 3000, urls=100, skew=1.2, bad_ratio=0.01)
+            benchmark.generate_log(os.path.join(tmp, 'nginx-access-ui-20170630.gz'), 3000, urls=100, skew=1.2,
+                                   bad_ratio=0.01)
+            with open(plain, 'rb') as f, open(os.path.join(tmp, 'copy.log'), 'rb') as copy:
+                self.assertEqual(f.read(), copy.read())
+
+            log = list(parser_log(FilePath('nginx-access-ui-20170630.log', None, 'log'), tmp, 20))
+            log_gz = list(parser_log(FilePath('nginx-access-ui-20170630.gz', None, 'gz'), tmp, 20, line_parser='fast'))
+            self.assertEqual(len(log), 3000)
+            self.assertEqual(log, log_gz)
+            counts = accumulate_stat(log).url_stats
+            self.assertLessEqual(len(counts), 100)
+            self.assertGreater(counts['/api/v2/banner/0'].count, counts['/api/v2/banner/50'].count)
+
 
 if __name__ == "__main__":
     unittest.main()
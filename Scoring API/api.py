@@ -2,15 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import abc
+import re
 import json
 import datetime
 import logging
 import hashlib
+import hmac
+import time
 import uuid
+import zlib
+import queue
+import functools
+from logging.handlers import QueueHandler, QueueListener
 from optparse import OptionParser
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
 
 import scoring
+from store import create_store, LRUCache
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -36,251 +45,396 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
-
-
-class CharField:
-    def __init__(self, required, nullable, name='', default=None):
-        self.name = "_" + name
-        self.type = str
+WORKERS = 16
+# idle keep-alive connection is closed after this number of seconds
+KEEP_ALIVE_TIMEOUT = 5
+# verified (account, login, token) of users
+AUTH_CACHE_SIZE = 10000
+BATCH_METHOD = "batch"
+# maximum number of calls in one batch
+MAX_BATCH_SIZE = 1000
+# patterns of strptime for '%d.%m.%Y', matching the same strings
+DATE_RE = re.compile(r'(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.(\d\d\d\d)\Z')
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats record as JSON object with time, level, message and request_id, context if the record has them"""
+
+    def format(self, record):
+        data = {"time": self.formatTime(record, self.datefmt), "level": record.levelname,
+                "message": record.getMessage()}
+        for name in ("request_id", "context"):
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class AccessSampler(logging.Filter):
+    """Passes INFO records with request_id of the rate share of requests, all of them for a sampled request"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.threshold = int(rate * 2 ** 32)
+
+    def filter(self, record):
+        request_id = getattr(record, "request_id", None)
+        if record.levelno != logging.INFO or request_id is None:
+            return True
+        return zlib.crc32(str(request_id).encode('utf-8')) < self.threshold
+
+
+class LogQueueHandler(QueueHandler):
+    """Puts records to the queue as is, messages are formatted by the listener thread,
+    so arguments of a record must not be changed after logging"""
+
+    def prepare(self, record):
+        if record.exc_info:
+            # traceback refers to frames of the request thread
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogListener(QueueListener):
+    """Writer thread of the log queue, stop flushes the queue and closes the handlers"""
+
+    def stop(self):
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+def setup_logging(log_file=None, sample_rate=1.0, logger=None):
+    """Route records of logger (root by default) through a queue to a writer thread
+    appending JSON lines to log_file (stderr if None). Return the started LogListener,
+    its stop closes log_file
+
+        Keyword arguments:
+        log_file -- path of the log
+        sample_rate -- share of requests whose INFO access records are logged
+        logger -- logger to set up
+        """
+    logger = logger or logging.getLogger()
+    handler = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler()
+    handler.setFormatter(JsonFormatter(datefmt='%Y.%m.%d %H:%M:%S'))
+    records = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(records)
+    if sample_rate < 1:
+        queue_handler.addFilter(AccessSampler(sample_rate))
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    listener = LogListener(records, handler)
+    listener.start()
+    return listener
+
+
+def validation_error(errors, message):
+    """Log validation error and add it to errors of the request"""
+    logging.error(f'Validation Error: {message};')
+    errors.append(message)
+
+
+class Field(object):
+    """Field of the request schema, clean checks the raw value once and returns the parsed one"""
+    type = object
+    type_error = ''
+
+    def __init__(self, required, nullable, default=None):
+        self.name = ''
         self.required = required
         self.nullable = nullable
         self.default = default
 
-    def __get__(self, instance, cls):
-        return getattr(instance, self.name, self.default)
-
-    def __set__(self, instance, value):
+    def check_required(self, value, errors):
         if self.required:
             if value is None:
-                # raise ValueError(f'attribute {self.name[1:]} is required')
-                logging.error(f'Validation Error: attribute {self.name[1:]} is required;')
+                validation_error(errors, f'attribute {self.name} is required')
             if not self.nullable and not value:
-                # raise ValueError(f"attribute {self.name[1:]} can't be null")
-                logging.error(f"Validation Error: attribute {self.name[1:]} can't be null;")
+                validation_error(errors, f"attribute {self.name} can't be null")
+
+    def clean(self, value, errors):
+        self.check_required(value, errors)
         if value and not isinstance(value, self.type):
-            # raise TypeError('Must be a str')
-            logging.error(f"Validation Error: attribute {self.name[1:]} must be a str;")
-        setattr(instance, self.name, value)
-    # def __delete__(self, instance):
-    #     raise AttributeError("Can't delete attribute")
+            validation_error(errors, f'attribute {self.name} {self.type_error}')
+        return value
 
 
-class DateField(object):
-    def __init__(self, required, nullable, name='', date_format='%d.%m.%Y', default=None):
-        self.name = "_" + name
-        self.type = str
-        self.required = required
-        self.nullable = nullable
-        self.date_format = date_format
-        self.default = default
+class CharField(Field):
+    type = str
+    type_error = 'must be a str'
 
-    def __get__(self, instance, cls):
-        return getattr(instance, self.name, self.default)
-        # __getattribute__
 
-    def __set__(self, instance, value):
-        if self.required:
-            if value is None:
-                logging.error(f'Validation Error: attribute {self.name[1:]} is required;')
-                # raise ValueError(f'attribute {self.name[1:]} is required')
-            if not self.nullable and not value:
-                # raise ValueError(f"attribute {self.name[1:]} can't be null")
-                logging.error(f"Validation Error: attribute {self.name[1:]} can't be null;")
-        if value and not isinstance(value, self.type):
-            # raise TypeError('Input date in str format')
-            logging.error(f'Validation Error: attribute {self.name[1:]} must be input in str format;')
-        try:
-            if value and isinstance(value, str):
-                datetime.datetime.strptime(value, self.date_format).date()
-                setattr(instance, self.name, datetime.datetime.strptime(value, self.date_format).date())
-        except ValueError:
-            # raise ValueError('Incorrect date format: must be DD.MM.YYYY')
-            logging.error(f'Validation Error: Attribute {self.name[1:]} must be str in DD.MM.YYYY format;')
+class DateField(Field):
+    type = str
+    type_error = 'must be input in str format'
 
+    def __init__(self, required, nullable, date_format='%d.%m.%Y', default=None):
+        super().__init__(required, nullable, default)
+        self.date_format = date_format
 
-class EmailField(CharField):
+    def clean(self, value, errors):
+        value = super().clean(value, errors)
+        if value and isinstance(value, str):
+            try:
+                if self.date_format == '%d.%m.%Y':
+                    match = DATE_RE.match(value)
+                    if match is None:
+                        raise ValueError(value)
+                    day, month, year = match.groups()
+                    return datetime.date(int(year), int(month), int(day))
+                return datetime.datetime.strptime(value, self.date_format).date()
+            except ValueError:
+                validation_error(errors, f'Attribute {self.name} must be str in DD.MM.YYYY format')
+        return self.default
 
-    def __init__(self, required, nullable, name='email'):
-        super().__init__(required, nullable, name='email')
-        self.name = "_" + 'email'
 
-    def __set__(self, instance, value):
+class EmailField(CharField):
+
+    def clean(self, value, errors):
         if value and isinstance(value, str):
             if '@' not in value:
-                # raise ValueError('Must contains @')
-                logging.error(f'Validation Error: attribute {self.name[1:]} must contains @;')
-            super().__set__(instance, value)
+                validation_error(errors, f'attribute {self.name} must contains @')
+            return super().clean(value, errors)
+        return self.default
 
 
 class PhoneField(CharField):
 
-    def __init__(self, required, nullable, name='phone'):
-        super().__init__(required, nullable, name='phone')
-        self.name = "_" + 'phone'
-
-    def __set__(self, instance, value):
+    def clean(self, value, errors):
         if value:
-            if not (isinstance(value, str) or isinstance(value, int)):
-                # raise TypeError("Must be a str or an int")
-                logging.error(f"Validation Error: attribute {self.name[1:]} Must be a str or an int;")
+            if not isinstance(value, (str, int)):
+                validation_error(errors, f"attribute {self.name} Must be a str or an int")
             elif len(str(value)) != 11:
-                # raise ValueError("It must contains 11 symbols")
-                logging.error(f"Validation Error: attribute {self.name[1:]} must contains 11 symbols;")
+                validation_error(errors, f"attribute {self.name} must contains 11 symbols")
             elif not str(value).startswith('7'):
-                # raise ValueError("It must starts with 7")
-                logging.error(f"Validation Error: attribute {self.name[1:]} must starts with 7;")
-            setattr(instance, self.name, value)
+                validation_error(errors, f"attribute {self.name} must starts with 7")
+            return value
+        return self.default
 
 
 class BirthDayField(DateField):
-    def __init__(self, required, nullable, name='birthday'):
-        super().__init__(required, nullable, name='birthday')
-        self.name = "_" + 'birthday'
 
-    def __set__(self, instance, value):
-        super().__set__(instance, value)
-        try:
-            date_birth = datetime.datetime.strptime(value, self.date_format).date()
-            if date_birth.replace(year=date_birth.year + 70) < datetime.datetime.now().date():
-                # raise ValueError('Age over 70 years!')
-                logging.error('Validation Error: Age over 70 years!;')
-            setattr(instance, self.name, date_birth)
-        except:
-            # logging.error(f'Validation Error: Attribute {self.name[1:]} must be str in DD.MM.YYYY format;')
-            pass
-
-
-class GenderField(object):
-    def __init__(self, required, nullable, name='gender', default=None):
-        self.name = "_" + name
-        self.type = int
-        self.values = GENDERS
-        self.required = required
-        self.nullable = nullable
-        self.default = default
+    def clean(self, value, errors):
+        date_birth = super().clean(value, errors)
+        if date_birth:
+            today = datetime.date.today()
+            if (date_birth.year + 70, date_birth.month, date_birth.day) < (today.year, today.month, today.day):
+                validation_error(errors, 'Age over 70 years!')
+        return date_birth
 
-    def __get__(self, instance, cls):
-        return getattr(instance, self.name, self.default)
 
-    def __set__(self, instance, value):
-        if self.required:
-            if value is None:
-                # raise ValueError(f'attribute {self.name[1:]} is required')
-                logging.error(f'Validation Error: attribute {self.name[1:]} is required;')
-            if not self.nullable and not value:
-                # raise ValueError(f"attribute {self.name[1:]} can't be null")
-                logging.error(f"Validation Error: attribute {self.name[1:]} can't be null;")
-        if value and not isinstance(value, self.type):
-            logging.error(f'Validation Error: attribute {self.name[1:]} must be an int;')
-        if isinstance(value, self.type) and value not in self.values:
-            # raise TypeError('Must be 0, 1 or 2')
-            logging.error(f'Validation Error: attribute {self.name[1:]} must be in {GENDERS};')
-        setattr(instance, self.name, value)
+class GenderField(Field):
+    type = int
+    type_error = 'must be an int'
 
+    def clean(self, value, errors):
+        value = super().clean(value, errors)
+        if isinstance(value, int) and value not in GENDERS:
+            validation_error(errors, f'attribute {self.name} must be in {GENDERS}')
+        return value
 
-class ArgumentsField(object):
-    def __init__(self, required, nullable, name='', default=None):
-        self.name = "_" + name
-        self.type = dict
-        self.required = required
-        self.nullable = nullable
-        self.default = default
-    def __get__(self, instance, cls):
-        return getattr(instance, self.name, self.default)
-    def __set__(self, instance, value):
-        if self.required:
-            if value is None:
-                # raise ValueError(f'attribute {self.name[1:]} is required')
-                logging.error(f'Validation Error: attribute {self.name[1:]} is required;')
-            if not self.nullable and not value:
-                # raise ValueError(f"attribute {self.name[1:]} can't be null")
-                logging.error(f"Validation Error: attribute {self.name[1:]} can't be null;")
-        if not isinstance(value, self.type):
-            # raise TypeError('Must be a dict')
-            logging.error(f'Validation Error: attribute {self.name[1:]} must be a dict;')
-        setattr(instance, self.name, value)
-
-
-class ClientIDsField(object):
-    def __init__(self, required, nullable, name='', default=None):
-        self.name = "_" + name
-        self.type = list
-        self.required = required
-        self.nullable = nullable
-        self.default = default
 
-    def __get__(self, instance, cls):
-        return getattr(instance, self.name, self.default)
+class ArgumentsField(Field):
+
+    def clean(self, value, errors):
+        self.check_required(value, errors)
+        if not isinstance(value, dict):
+            validation_error(errors, f'attribute {self.name} must be a dict')
+        return value
+
+
+class ClientIDsField(Field):
+    type = list
+    type_error = 'must be a list'
+
+    def clean(self, value, errors):
+        value = super().clean(value, errors)
+        if value and isinstance(value, list) and not all(isinstance(i, int) for i in value):
+            validation_error(errors, "Client id's must be integer")
+        return value
 
-    def __set__(self, instance, value):
-        if self.required:
-            if value is None:
-                # raise ValueError(f'attribute {self.name[1:]} is required')
-                logging.error(f'Validation Error: attribute {self.name[1:]} is required;')
-            if not self.nullable and not value:
-                # raise ValueError(f"attribute {self.name[1:]} can't be null")
-                logging.error(f"Validation Error: attribute {self.name[1:]} can't be null;")
-        if value and not isinstance(value, self.type):
-            # raise TypeError('Must be a list')
-            logging.error(f'Validation Error: attribute {self.name[1:]} must be a list;')
-        if value and isinstance(value, self.type):
-            err = 0
-            for i in value:
-                if not isinstance(i, int):
-                    err += 1
-            if err:
-                # raise TypeError("Client id's must be integer")
-                logging.error("Validation Error: Client id's must be integer;")
-        setattr(instance, self.name, value)
-
-
-class ClientsInterestsRequest(object):
-    client_ids = ClientIDsField(required=True, nullable=False, name='client_ids')
-    date = DateField(required=False, nullable=True, name='date')
-
-
-class OnlineScoreRequest(object):
-    first_name = CharField(required=False, nullable=True, name='first_name')
-    last_name = CharField(required=False, nullable=True, name='last_name')
-    email = EmailField(required=False, nullable=True, name='email')
-    phone = PhoneField(required=False, nullable=True, name='phone')
-    birthday = BirthDayField(required=False, nullable=True, name='birthday')
-    gender = GenderField(required=False, nullable=True, name='gender')
-
-
-class MethodRequest(object):
-    account = CharField(required=False, nullable=True, name='account')
-    login = CharField(required=True, nullable=True, name='login')
-    token = CharField(required=True, nullable=True, name='token')
-    arguments = ArgumentsField(required=True, nullable=True, name='arguments')
-    method = CharField(required=True, nullable=True, name='method')
+
+def compile_validator(fields):
+    """Return validate(self, data) setting all fields of the request from dict data,
+    one generated statement per field instead of a descriptor call"""
+    namespace = {}
+    lines = ['def validate(self, data):', '    get = data.get', '    errors = self.errors']
+    for i, (name, field) in enumerate(fields.items()):
+        namespace[f'clean_{i}'] = field.clean
+        lines.append(f'    self.{name} = clean_{i}(get({name!r}), errors)')
+    exec('\n'.join(lines), namespace)
+    return namespace['validate']
+
+
+class RequestMeta(type):
+    """Collect fields of the request class in declaration order, keep their values in __slots__
+    and compile the validation function of the class"""
+
+    def __new__(mcs, name, bases, namespace):
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, 'fields', {}))
+        own = {key: value for key, value in namespace.items() if isinstance(value, Field)}
+        for key, field in own.items():
+            field.name = key
+            del namespace[key]
+        fields.update(own)
+        namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + tuple(own)
+        namespace['fields'] = fields
+        namespace['validate'] = compile_validator(fields)
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class Request(metaclass=RequestMeta):
+    """Request validated on creation, fields are validated in the order of declaration"""
+    __slots__ = ('errors',)
+
+    def __init__(self, data=None, errors=None):
+        # validation errors, the list may be shared by nested requests
+        self.errors = [] if errors is None else errors
+        self.validate(data if isinstance(data, dict) else {})
+
+
+class ClientsInterestsRequest(Request):
+    client_ids = ClientIDsField(required=True, nullable=False)
+    date = DateField(required=False, nullable=True)
+
+
+class OnlineScoreRequest(Request):
+    phone = PhoneField(required=False, nullable=True)
+    email = EmailField(required=False, nullable=True)
+    first_name = CharField(required=False, nullable=True)
+    last_name = CharField(required=False, nullable=True)
+    birthday = BirthDayField(required=False, nullable=True)
+    gender = GenderField(required=False, nullable=True)
+
+
+class MethodRequest(Request):
+    account = CharField(required=False, nullable=True)
+    login = CharField(required=True, nullable=True)
+    method = CharField(required=True, nullable=True)
+    token = CharField(required=True, nullable=True)
+    arguments = ArgumentsField(required=True, nullable=True)
 
     @property
     def is_admin(self):
         return self.login == ADMIN_LOGIN
 
 
+auth_cache = LRUCache(AUTH_CACHE_SIZE)
+# (end of the hour as timestamp, admin digest of the hour)
+admin_digest_cache = (0, '')
+
+
+def get_admin_digest():
+    """Return admin digest of the current local hour, computed once per hour"""
+    global admin_digest_cache
+    valid_until, digest = admin_digest_cache
+    if time.time() >= valid_until:
+        now = datetime.datetime.now()
+        digest = hashlib.sha512(now.strftime("%Y%m%d%H").encode('utf-8') + ADMIN_SALT.encode('utf-8')).hexdigest()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        admin_digest_cache = ((hour + datetime.timedelta(hours=1)).timestamp(), digest)
+    return digest
+
+
 def check_auth(request):
+    token = request.token
+    if not isinstance(token, str):
+        return False
     if request.is_admin:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H").encode('utf-8') + ADMIN_SALT.encode('utf-8')).hexdigest()
+        digest = get_admin_digest()
     else:
-        digest = hashlib.sha512(str(request.account).encode('utf-8') + str(request.login).encode('utf-8') + SALT.encode('utf-8')).hexdigest()
-    # print(f'digest: {digest}')
-    if digest == request.token:
-        return True
-    return False
-
+        key = (str(request.account), str(request.login), token)
+        if auth_cache.get(key):
+            return True
+        digest = hashlib.sha512(key[0].encode('utf-8') + key[1].encode('utf-8') + SALT.encode('utf-8')).hexdigest()
+    if not hmac.compare_digest(digest.encode('utf-8'), token.encode('utf-8', 'surrogatepass')):
+        return False
+    if not request.is_admin:
+        auth_cache.set(key, True)
+    return True
+
+
+def validate_online_score(arguments, errors):
+    """Return OnlineScoreRequest validated from arguments"""
+    online_score_request = OnlineScoreRequest(arguments, errors)
+    if not (online_score_request.phone and online_score_request.email) and \
+            not (online_score_request.first_name and online_score_request.last_name) and \
+            not (online_score_request.gender != "" and online_score_request.birthday):
+        validation_error(errors, 'At least one pair phone-email, first name-last name, gender-birthday should be filled')
+    return online_score_request
+
+
+def interests_response(interests, client_ids):
+    """Return response, code and failed clients for client_ids from dict of fetched interests,
+    interests of failed clients are null unless all of them failed"""
+    values = {cid: interests.get(cid) for cid in client_ids}
+    failed = [cid for cid, v in values.items() if v is None]
+    if failed and len(failed) == len(values):
+        return None, INTERNAL_ERROR, failed
+    return {str(cid): v for cid, v in values.items()}, OK, failed
+
+
+def batch_handler(arguments, is_admin, context, router, store):
+    """Return list of results of calls {"method": ..., "arguments": ...} in arguments["requests"]
+    and the code of the batch. Each result is {"code": ..., "response": ...} or {"code": ..., "error": ...},
+    interests of all clients_interests calls are fetched together"""
+    calls = arguments.get("requests")
+    if not isinstance(calls, list) or not calls:
+        return "attribute requests must be a non-empty list", INVALID_REQUEST
+    if len(calls) > MAX_BATCH_SIZE:
+        return f"attribute requests must contain at most {MAX_BATCH_SIZE} calls", INVALID_REQUEST
+    results = [None] * len(calls)
+    interests_calls = []
+    for i, call in enumerate(calls):
+        method = call.get("method") if isinstance(call, dict) else None
+        call_arguments = call.get("arguments") if isinstance(call, dict) else None
+        errors = []
+        if method == "online_score":
+            if is_admin:
+                results[i] = {"code": OK, "response": {"score": 42}}
+                continue
+            online_score_request = validate_online_score(call_arguments, errors)
+            if not errors:
+                try:
+                    results[i] = {"code": OK, "response": {"score": router["online_score"](store, online_score_request)}}
+                except Exception:
+                    logging.exception('Score of batch call %s is failed', i)
+                    results[i] = {"code": INTERNAL_ERROR, "error": ERRORS[INTERNAL_ERROR]}
+        elif method == "clients_interests":
+            clients_interests = ClientsInterestsRequest(call_arguments, errors)
+            if not errors:
+                interests_calls.append((i, clients_interests.client_ids))
+        else:
+            results[i] = {"code": NOT_FOUND, "error": f"unknown method {method}"}
+        if errors:
+            results[i] = {"code": INVALID_REQUEST, "error": '; '.join(errors)}
 
-def method_handler(request, context, log_file_name, router, store):
+    if interests_calls:
+        try:
+            interests = router["clients_interests"](store, [cid for _, ids in interests_calls for cid in ids])
+        except Exception:
+            logging.exception('Interests of batch calls are failed')
+            interests = {}
+        for i, client_ids in interests_calls:
+            response, code, _ = interests_response(interests, client_ids)
+            results[i] = {"code": code, "response": response} if code == OK else \
+                {"code": code, "error": ERRORS[code]}
+    context['ncalls'] = len(calls)
+    context['codes'] = [r["code"] for r in results]
+    return results, OK
+
+
+def method_handler(request, context, router, store):
     response, code = None, None
-    logging.info(f'context: {context}')
-    new_request = MethodRequest()
+    logging.info('context', extra={'request_id': context.get('request_id'), 'context': dict(context)})
     # Field validation
-    new_request.account = request.get('account')
-    new_request.login = request.get('login')
-    new_request.method = request.get('method')
-    new_request.token = request.get('token')
-    new_request.arguments = request.get('arguments')
+    new_request = MethodRequest(request)
+    errors = new_request.errors
     # Auth
     check_result = check_auth(new_request)
     if check_result:
@@ -290,51 +444,13 @@ def method_handler(request, context, log_file_name, router, store):
                 code, response = OK, {"score": 42}
                 # result = {"code": OK, "response": {"score": 42}}
             else:
-                online_score_request = OnlineScoreRequest()
-                if request.get('arguments'):
-                    online_score_request.phone = request.get('arguments').get('phone')
-                    online_score_request.email = request.get('arguments').get('email')
-                    online_score_request.first_name = request.get('arguments').get('first_name')
-                    online_score_request.last_name = request.get('arguments').get('last_name')
-                    online_score_request.birthday = request.get('arguments').get('birthday')
-                    online_score_request.gender = request.get('arguments').get('gender')
-                else:
-                    online_score_request.phone = online_score_request.email = online_score_request.first_name\
-                        = online_score_request.last_name = online_score_request.birthday = online_score_request.gender = None
-
-                if not (online_score_request.phone and online_score_request.email) and \
-                        not (online_score_request.first_name and online_score_request.last_name) and \
-                        not (online_score_request.gender != "" and online_score_request.birthday):
-                    logging.error(
-                        'Validation Error: At least one pair phone-email, first name-last name, gender-birthday should be filled;')
+                online_score_request = validate_online_score(new_request.arguments, errors)
         # elif request.get('method') == 'clients_interests':
         elif new_request.method == 'clients_interests':
-            clients_interests = ClientsInterestsRequest()
-            if request.get('arguments'):
-                clients_interests.client_ids = request.get('arguments').get('client_ids')
-                clients_interests.date = request.get('arguments').get('date')
-            else:
-                clients_interests.client_ids = clients_interests.date = None
-
-        #  Check validation errors
-        err_msg = ''
-        with open(log_file_name) as f:
-            for num, line in enumerate(f, 1):
-                if context["request_id"] in line:
-                    line_start = num
-                    break
-            # lines = f.readlines()[need_line:]
-            try:
-                for num, line in enumerate(f, line_start + 1):
-                    if 'Validation Error:' in line:
-                        # with open('api_log.log', encoding='utf-8') as f:
-                        #     for line in f:
-                        #         if 'Validation Error:' in line:
-                        err_msg += line[line.rfind('Error:') + len('Error:') + 1:].replace('\n', ' ')
-            except:
-                logging.exception('Errors with getting info from log file')
-        if err_msg:
-            code, response = INVALID_REQUEST, err_msg[:-2]
+            clients_interests = ClientsInterestsRequest(new_request.arguments, errors)
+
+        if errors:
+            code, response = INVALID_REQUEST, '; '.join(errors)
             # result = {"code": INVALID_REQUEST, "error": err_msg}
         else:
             # Calculation
@@ -348,49 +464,90 @@ def method_handler(request, context, log_file_name, router, store):
                     context['has'] = [k for k, v in new_request.arguments.items() if v != ""]
                 # elif new_request.method == 'clients_interests':
                 elif new_request.method == 'clients_interests':
-                    interests_list = {}
                     context['nclients'] = len(clients_interests.client_ids)
-
-                    for id in clients_interests.client_ids:
-                        interests_list[str(id)] = router.get(new_request.method)(store, id)
-                    code, response = OK, interests_list
+                    interests = router.get(new_request.method)(store, clients_interests.client_ids)
+                    response, code, failed = interests_response(interests, clients_interests.client_ids)
+                    if failed:
+                        context['failed'] = failed
+                elif new_request.method == BATCH_METHOD:
+                    response, code = batch_handler(new_request.arguments, new_request.is_admin, context, router, store)
             except:
                 code = INTERNAL_ERROR
     else:
         code = FORBIDDEN
-        logging.info(f'Authentication for {new_request.account} is failed')
+        logging.info('Authentication for %s is failed', new_request.account,
+                     extra={'request_id': context.get('request_id')})
     return response, code
 
 
-def main_http_handler(log_file_name):
+class PoolHTTPServer(HTTPServer):
+    """HTTP server handling connections in a pool of worker threads,
+    a keep-alive connection occupies a worker until it is closed or idle for KEEP_ALIVE_TIMEOUT"""
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=WORKERS):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def main_http_handler(store, interests_batch_size=scoring.INTERESTS_BATCH_SIZE):
+    """Return handler class serving requests with store, the store is shared by all worker threads.
+    Interests are fetched with one multi-get per interests_batch_size clients"""
     class MainHTTPHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        timeout = KEEP_ALIVE_TIMEOUT
+        # headers and body are separate writes, with Nagle a kept-alive client waits for delayed ACK
+        disable_nagle_algorithm = True
+
         def __init__(self, *args, **kwargs):
             super(MainHTTPHandler, self).__init__(*args, **kwargs)
 
         def get_request_id(self, headers):
             return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+        def log_message(self, format, *args):
+            # through the logging queue instead of stderr
+            logging.info("%s " + format, self.address_string(), *args,
+                         extra={'request_id': getattr(self, 'request_id', None)})
+
         def do_POST(self):
             router = {
                 "online_score": scoring.get_score,
-                "clients_interests": scoring.get_interests
+                "clients_interests": functools.partial(scoring.get_interests_many, batch_size=interests_batch_size)
             }
-            store = None
             response, code = {}, OK
             context = {"request_id": self.get_request_id(self.headers)}
+            self.request_id = context["request_id"]
             request = None
             try:
                 data_string = self.rfile.read(int(self.headers['Content-Length']))
                 request = json.loads(data_string)
             except:
                 code = BAD_REQUEST
+                # the rest of the body can not be skipped
+                self.close_connection = True
 
             if request:
                 path = self.path.strip("/")
-                logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+                logging.info("%s: %s", self.path, data_string, extra={'request_id': context["request_id"]})
                 response = None
-                if path in router:
-                    response, code = method_handler(request, context, log_file_name, router, store)
+                if path in router or path == BATCH_METHOD:
+                    response, code = method_handler(request, context, router, store)
                 else:
                     code = NOT_FOUND
 
@@ -399,40 +556,70 @@ def main_http_handler(log_file_name):
                 else:
                     r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
 
-            self.send_response(code)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
             if code not in ERRORS:
                 r = {"response": response, "code": code}
             else:
                 r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
             context.update(r)
-            logging.info(context)
-            self.wfile.write(json.dumps(r).encode('utf-8'))
+            logging.info('response', extra={'request_id': context["request_id"], 'context': dict(context)})
+            self.send_json(code, r)
+
+        def do_GET(self):
+            self.request_id = None
+            if self.path.strip("/") == "stats":
+                self.send_json(OK, {"response": {"score_cache": scoring.score_cache.stats()}, "code": OK})
+            else:
+                self.send_json(NOT_FOUND, {"error": ERRORS[NOT_FOUND], "code": NOT_FOUND})
+
+        def send_json(self, code, r):
+            body = json.dumps(r).encode('utf-8')
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
     return MainHTTPHandler
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8000)
     op.add_option("-l", "--log", action="store", default="api_log.log")
+    op.add_option("--log-sample", action="store", type=float, default=1.0,
+                  help="share of requests whose INFO access records are logged")
+    op.add_option("-w", "--workers", action="store", type=int, default=WORKERS)
+    op.add_option("-s", "--store", action="store", default="memory://",
+                  help="memory://, redis://host:port or unix:///path/to/socket")
+    op.add_option("--interests-batch-size", action="store", type=int, default=scoring.INTERESTS_BATCH_SIZE,
+                  help="clients whose interests are fetched with one multi-get of the store")
+    op.add_option("--score-cache-size", action="store", type=int, default=scoring.SCORE_CACHE_SIZE,
+                  help="scores cached in process, 0 disables the cache")
+    op.add_option("--score-cache-ttl", action="store", type=int, default=scoring.SCORE_CACHE_TTL)
+    op.add_option("--score-cache-shared", action="store_true", default=False,
+                  help="share cached scores between servers through the store")
+    op.add_option("--score-cache-timeout", action="store", type=float, default=scoring.SCORE_CACHE_TIMEOUT,
+                  help="seconds to wait for the shared score cache")
     (opts, args) = op.parse_args()
 
-    logging.basicConfig(
-        filename=opts.log,
-        # filemode='w',
-        format="%(asctime)s %(levelname).1s %(message)s",
-        datefmt='%Y.%m.%d %H:%M:%S',
-        level=logging.INFO
-    )
-    MainHandler = main_http_handler(opts.log)
-    server = HTTPServer(('127.0.0.1', 8000), MainHandler)
-    logging.info("Starting server at %s" % opts.port)
+    listener = setup_logging(opts.log, opts.log_sample)
+    store = create_store(opts.store)
+    # the shared score cache has own connections with a short timeout, a slow store does not delay scoring
+    cache_store = create_store(opts.store, timeout=opts.score_cache_timeout, retries=0) \
+        if opts.score_cache_shared else None
+    scoring.score_cache = scoring.ScoreCache(opts.score_cache_size, opts.score_cache_ttl, opts.score_cache_shared,
+                                             cache_store)
+    MainHandler = main_http_handler(store, opts.interests_batch_size)
+    server = PoolHTTPServer(('127.0.0.1', opts.port), MainHandler, opts.workers)
+    logging.info("Starting server at %s with %s workers" % (opts.port, opts.workers))
 
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         logging.debug('Server is down')
     server.server_close()
+    store.close()
+    if cache_store:
+        cache_store.close()
+    listener.stop()
 
 
 
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import timeit
+import hashlib
+import datetime
+import threading
+import http.client
+import logging
+import importlib.util
+from optparse import OptionParser
+
+import api
+import scoring
+from store import create_store
+
+TOKEN = hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('utf-8')).hexdigest()
+ADMIN_TOKEN = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode('utf-8')).hexdigest()
+
+ARGUMENTS = {
+    "valid": {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "Стансилав",
+              "last_name": "Ступников", "birthday": "01.01.1990", "gender": 1},
+    "invalid": {"phone": "89175002040", "email": "stupnikovotus.ru", "first_name": 1,
+                "last_name": "Ступников", "birthday": "01.01.1890", "gender": 3},
+}
+AUTH = {
+    "user": {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": TOKEN, "arguments": {}},
+    "admin": {"account": "horns&hoofs", "login": "admin", "method": "online_score", "token": ADMIN_TOKEN,
+              "arguments": {}},
+}
+# order in which the previous descriptor based method_handler assigned fields
+FIELDS = {
+    "OnlineScoreRequest": ("phone", "email", "first_name", "last_name", "birthday", "gender"),
+    "MethodRequest": ("account", "login", "method", "token", "arguments"),
+}
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location("baseline_api", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_request(module, data, name="OnlineScoreRequest"):
+    """Create and validate request class of module, with either schema or descriptor fields"""
+    cls = getattr(module, name)
+    if hasattr(module, 'RequestMeta'):
+        return cls(data)
+    request = cls()
+    for field in FIELDS[name]:
+        setattr(request, field, data.get(field))
+    return request
+
+
+def auth(module, data):
+    """Return function checking auth of the request created once"""
+    request = build_request(module, data, "MethodRequest")
+
+    def check():
+        if not module.check_auth(request):
+            raise AssertionError("authentication failed")
+    return check
+
+
+def handle(module, data):
+    request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": TOKEN, "arguments": data}
+    return module.method_handler(request, {}, {"online_score": lambda store, r: 0}, None)
+
+
+def bench_http(calls):
+    """Return time per call in microseconds of single requests and of one batch over a keep-alive connection"""
+    server = api.PoolHTTPServer(('127.0.0.1', 0), api.main_http_handler(create_store("memory://")), workers=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+    arguments = [{"phone": "7917%07d" % i, "email": "stupnikov@otus.ru"} for i in range(calls)]
+
+    def post(method, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": method, "token": TOKEN, "arguments": arguments}
+        conn.request('POST', f'/{method}/', json.dumps(request))
+        return json.loads(conn.getresponse().read())
+
+    try:
+        scoring.score_cache = scoring.ScoreCache()
+        start = time.perf_counter()
+        for data in arguments:
+            assert post("online_score", data)["code"] == api.OK
+        single = time.perf_counter() - start
+        scoring.score_cache = scoring.ScoreCache()
+        start = time.perf_counter()
+        assert post(api.BATCH_METHOD, {"requests": [{"method": "online_score", "arguments": data}
+                                                    for data in arguments]})["code"] == api.OK
+        batch = time.perf_counter() - start
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    return single / calls * 1e6, batch / calls * 1e6
+
+
+def bench(func, number, repeat):
+    """Return the best time of one call in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    op = OptionParser(usage="%prog [options]", description="Microbenchmark of request validation")
+    op.add_option("-b", "--baseline", help="api.py to compare with, e.g. from git show <commit>:'Scoring API/api.py'")
+    op.add_option("-n", "--number", type=int, default=20000)
+    op.add_option("-r", "--repeat", type=int, default=5)
+    op.add_option("--http", type=int, default=1000, help="online_score calls sent over HTTP one by one and in a batch")
+    (opts, args) = op.parse_args()
+    # validation errors are logged, measure validation itself
+    logging.disable(logging.CRITICAL)
+
+    modules = [("current", api)]
+    if opts.baseline:
+        modules.insert(0, ("baseline", load_module(opts.baseline)))
+    # case, stage and function returning the function to measure for a module
+    runs = []
+    for case, data in ARGUMENTS.items():
+        runs.append((case, "request", lambda module, data=data: lambda: build_request(module, data)))
+        runs.append((case, "method_handler", lambda module, data=data: lambda: handle(module, data)))
+    for case, data in AUTH.items():
+        runs.append((case, "auth", lambda module, data=data: auth(module, data)))
+
+    results = {}
+    for case, stage, prepare in runs:
+        for name, module in modules:
+            results[case, stage, name] = bench(prepare(module), opts.number, opts.repeat)
+            line = f"{case:8} {stage:15} {name:9} {results[case, stage, name]:8.2f} us"
+            if name == "current" and opts.baseline:
+                line += f"  x{results[case, stage, 'baseline'] / results[case, stage, name]:.2f}"
+            print(line)
+    if opts.http:
+        single, batch = bench_http(opts.http)
+        print(f"{'http':8} {'online_score':15} {'single':9} {single:8.2f} us")
+        print(f"{'http':8} {'online_score':15} {'batch':9} {batch:8.2f} us  x{single / batch:.2f}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,142 @@
-import random
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+from collections import Counter
+
+from store import StoreError, LRUCache
+
+# maximum number of keys in one multi-get of the store
+INTERESTS_BATCH_SIZE = 100
+SCORE_CACHE_SIZE = 10000
+# seconds
+SCORE_CACHE_TTL = 60 * 60
+# seconds to wait for the shared cache, a score is computed in microseconds
+SCORE_CACHE_TIMEOUT = 0.05
+# seconds the shared cache is not asked after its error
+SCORE_CACHE_BREAK = 10
+# scores waiting to be written to the shared cache, the others are dropped
+SCORE_CACHE_WRITES = 1000
+
+
+class ScoreCache(object):
+    """Cache of scores in process LRU and, if shared, in the store. The store is asked without retries,
+    its errors are counted and the score is computed in process. After an error the store is skipped
+    for break_time seconds; computed scores are written to the store by a background thread
+
+        Keyword arguments:
+        maxsize, ttl -- size and time to live of the cache
+        shared -- share scores through the store
+        store -- store of the shared scores, with a short timeout, the store of the request by default
+        break_time -- seconds the store is skipped after its error
+        """
+
+    def __init__(self, maxsize=SCORE_CACHE_SIZE, ttl=SCORE_CACHE_TTL, shared=False, store=None,
+                 break_time=SCORE_CACHE_BREAK):
+        self.local = LRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self.shared = shared
+        self.store = store
+        self.break_time = break_time
+        self.broken_until = 0
+        self.writes = queue.Queue(SCORE_CACHE_WRITES)
+        self.writer = None
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(online_score_request):
+        r = online_score_request
+        fields = [r.phone, r.email, r.first_name, r.last_name, r.birthday.isoformat() if r.birthday else None,
+                  r.gender]
+        return "score:" + hashlib.md5(json.dumps(fields, default=str).encode('utf-8')).hexdigest()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = {name: self.counters[name] for name in ('hits', 'store_hits', 'misses', 'store_errors')}
+        stats['size'] = len(self.local)
+        return stats
+
+    def fail(self, e):
+        """Count the error of the store and skip the store for break_time seconds"""
+        logging.warning(f'Score cache of the store is unavailable for {self.break_time}s: {e}')
+        with self.lock:
+            self.counters['store_errors'] += 1
+            self.broken_until = time.monotonic() + self.break_time
+
+    def available(self):
+        return time.monotonic() >= self.broken_until
+
+    def write_back(self, store, key, score):
+        """Queue the score to be written to the store, it is dropped when the queue is full"""
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+        try:
+            self.writes.put_nowait((store, key, json.dumps(score)))
+        except queue.Full:
+            pass
+
+    def write_loop(self):
+        while True:
+            store, key, value = self.writes.get()
+            try:
+                if self.available():
+                    store.set(key, value, self.ttl, retries=0)
+            except Exception as e:
+                self.fail(e)
+            finally:
+                self.writes.task_done()
+
+    def flush(self):
+        """Wait until queued scores are written"""
+        self.writes.join()
+
+    def get(self, store, online_score_request, compute):
+        """Return cached score of the request or compute and cache it"""
+        key = self.key(online_score_request)
+        score = self.local.get(key)
+        if score is not None:
+            self.count('hits')
+            return score
+        store = self.store or store
+        shared = self.shared and store is not None and self.available()
+        if shared:
+            try:
+                r = store.get(key, retries=0)
+                if r is not None:
+                    score = json.loads(r)
+            except Exception as e:
+                # any failure of the store falls back to computing
+                self.fail(e)
+                shared = False
+            if score is not None:
+                self.count('store_hits')
+                self.local.set(key, score)
+                return score
+        self.count('misses')
+        score = compute(online_score_request)
+        self.local.set(key, score)
+        if shared:
+            self.write_back(store, key, score)
+        return score
+
+
+score_cache = ScoreCache()
 
 
 def get_score(store, online_score_request):
+    return score_cache.get(store, online_score_request, compute_score)
+
+
+def compute_score(online_score_request):
     score = 0
     if online_score_request.phone:
         score += 1.5
@@ -15,6 +150,28 @@ def get_score(store, online_score_request):
 
 
 def get_interests(store, cid):
-    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-    return random.sample(interests, 2)
+    r = store.get("i:%s" % cid)
+    return json.loads(r) if r else []
+
+
+def get_interests_many(store, cids, batch_size=INTERESTS_BATCH_SIZE):
+    """Return dict client id: interests, fetched with one multi-get per batch_size clients.
+    Interests of clients whose batch failed or whose value is broken are None"""
+    cids = list(dict.fromkeys(cids))
+    interests = {}
+    for start in range(0, len(cids), batch_size):
+        batch = cids[start:start + batch_size]
+        try:
+            values = store.get_many(["i:%s" % cid for cid in batch])
+        except StoreError as e:
+            logging.error(f'Interests of {len(batch)} clients are not fetched: {e}')
+            interests.update(dict.fromkeys(batch))
+            continue
+        for cid, r in zip(batch, values):
+            try:
+                interests[cid] = json.loads(r) if r else []
+            except ValueError:
+                logging.error(f'Broken interests of client {cid}: {r!r}')
+                interests[cid] = None
+    return interests
 
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import socket
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+POOL_SIZE = 16
+# seconds to wait for a connection of the pool, a connect and every read of a reply,
+# a call that timed out is not retried
+TIMEOUT = 3
+RETRIES = 3
+# delay before the first retry, doubled for every next one
+RETRY_DELAY = 0.05
+
+
+class StoreError(Exception):
+    pass
+
+
+class ResponseError(StoreError):
+    """Error reply of the server, the connection is still usable"""
+
+
+class MemoryStorage(object):
+    """Thread-safe in-process key-value storage with expiration, stand-in for the store server"""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def connect(self, timeout=None):
+        # all connections share the same data
+        return self
+
+    def close(self):
+        pass
+
+    def _get(self, key, now):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expire_at = item
+        if expire_at is not None and expire_at <= now:
+            del self.data[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key, time.monotonic())
+
+    def mget(self, keys):
+        now = time.monotonic()
+        with self.lock:
+            return [self._get(key, now) for key in keys]
+
+    def set(self, key, value, expire=None):
+        with self.lock:
+            self.data[key] = (str(value), time.monotonic() + expire if expire else None)
+
+
+class LRUCache(object):
+    """Thread-safe in-process cache of at most maxsize items living ttl seconds, least recently used are evicted"""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            value, expire_at = item
+            if expire_at is not None and expire_at <= time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expire_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (value, expire_at)
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+class RedisConnection(object):
+    """Connection speaking Redis protocol over TCP (host, port) or Unix socket path"""
+
+    def __init__(self, address, timeout=TIMEOUT):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            try:
+                self.sock.connect(address)
+            except OSError:
+                self.sock.close()
+                raise
+        else:
+            self.sock = socket.create_connection(address, timeout)
+        self.file = self.sock.makefile('rb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    @staticmethod
+    def encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def read_reply(self):
+        line = self.file.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('connection closed by the store')
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data.decode('utf-8')
+        if kind == b'-':
+            raise ResponseError(data.decode('utf-8'))
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            size = int(data)
+            if size < 0:
+                return None
+            value = self.file.read(size + 2)
+            if len(value) != size + 2:
+                raise ConnectionError('connection closed by the store')
+            return value[:-2].decode('utf-8')
+        if kind == b'*':
+            size = int(data)
+            return None if size < 0 else [self.read_reply() for _ in range(size)]
+        raise ConnectionError(f'unexpected reply {line!r}')
+
+    def execute(self, *commands):
+        """Send commands in one write and return their replies"""
+        self.sock.sendall(b''.join(self.encode(args) for args in commands))
+        return [self.read_reply() for _ in commands]
+
+    def get(self, key):
+        return self.execute(('GET', key))[0]
+
+    def mget(self, keys):
+        return self.execute(('MGET',) + tuple(keys))[0] if keys else []
+
+    def set(self, key, value, expire=None):
+        args = ('SET', key, value) + (('EX', int(expire)) if expire else ())
+        self.execute(args)
+
+
+class ConnectionPool(object):
+    """Bounded pool of connections created on demand and shared by threads"""
+
+    def __init__(self, connect, size=POOL_SIZE, timeout=TIMEOUT):
+        self.connect = connect
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise StoreError('all connections of the pool are busy')
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.connect(self.timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection, broken=False):
+        if broken:
+            connection.close()
+        else:
+            self.idle.put(connection)
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Store(object):
+    """Key-value store client: pooled connections, reconnect and retries on connection errors.
+    Timeouts are not retried, a silent store costs a call one timeout instead of one per attempt"""
+
+    def __init__(self, connect, pool_size=POOL_SIZE, timeout=TIMEOUT, retries=RETRIES, retry_delay=RETRY_DELAY):
+        self.pool = ConnectionPool(connect, pool_size, timeout)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def call(self, method, *args, retries=None):
+        """Call method of a pooled connection, a broken connection is dropped and the call is retried
+        on a new one, StoreError is raised when retries are exhausted or at once when the store timed out
+        or its reply is malformed"""
+        retries = self.retries if retries is None else retries
+        delay = self.retry_delay
+        for attempt in range(retries + 1):
+            connection = None
+            try:
+                connection = self.pool.acquire()
+                result = getattr(connection, method)(*args)
+            except socket.timeout as e:
+                # a slow store is not asked again, the caller must not wait retries times timeout
+                if connection is not None:
+                    self.pool.release(connection, broken=True)
+                raise StoreError(f'{method} timed out: {e}') from e
+            except OSError as e:
+                if connection is not None:
+                    self.pool.release(connection, broken=True)
+                if attempt == retries:
+                    raise StoreError(f'{method} failed after {attempt + 1} attempts: {e}') from e
+                logging.warning(f'Store {method} failed: {e}, retry in {delay}s')
+                time.sleep(delay)
+                delay *= 2
+            except ResponseError:
+                self.pool.release(connection)
+                raise
+            except ValueError as e:
+                # int() or decode() of a malformed reply, the rest of the reply is left in the connection
+                self.pool.release(connection, broken=True)
+                raise StoreError(f'{method} got malformed reply: {e}') from e
+            except BaseException:
+                if connection is not None:
+                    self.pool.release(connection, broken=True)
+                raise
+            else:
+                self.pool.release(connection)
+                return result
+
+    def get(self, key, retries=None):
+        return self.call('get', key, retries=retries)
+
+    def get_many(self, keys):
+        """Return values of keys in one round trip"""
+        return self.call('mget', keys)
+
+    def set(self, key, value, expire=None, retries=None):
+        return self.call('set', key, value, expire, retries=retries)
+
+    def close(self):
+        self.pool.close()
+
+
+def create_store(url, **kwargs):
+    """Return Store for url: memory://, redis://host:port or unix:///path/to/socket
+
+        Keyword arguments:
+        url -- address of the store
+        kwargs -- pool_size, timeout, retries, retry_delay of Store
+        """
+    parts = urlsplit(url)
+    if parts.scheme == 'memory':
+        return Store(MemoryStorage().connect, **kwargs)
+    if parts.scheme == 'redis':
+        address = (parts.hostname or 'localhost', parts.port or 6379)
+        return Store(lambda timeout: RedisConnection(address, timeout), **kwargs)
+    if parts.scheme == 'unix':
+        return Store(lambda timeout: RedisConnection(parts.path, timeout), **kwargs)
+    raise ValueError(f'Unknown store {url}')
@@ -1,12 +1,21 @@
 import hashlib
 import datetime
 import functools
+import http.client
+import json
 import logging
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 
 import api
 import scoring
+import store
 
 logging.basicConfig(
     filename='api_log.log',
@@ -31,15 +40,17 @@ class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {"request_id": uuid.uuid4().hex}
         self.headers = {}
-        self.store = None
-        self.log_file_name = 'api_log.log'
+        self.store = store.create_store("memory://")
+        interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+        for cid in range(4):
+            self.store.set("i:%s" % cid, json.dumps(interests[cid:cid + 2]))
         self.router = {
             "online_score": scoring.get_score,
-            "clients_interests": scoring.get_interests
+            "clients_interests": scoring.get_interests_many
         }
 
     def get_response(self, request):
-        return api.method_handler(request, self.context, self.log_file_name, self.router, self.store)
+        return api.method_handler(request, self.context, self.router, self.store)
 
     # def set_valid_auth(self, request):
     #     if request.get("login") == api.ADMIN_LOGIN:
@@ -165,5 +176,509 @@ class TestSuite(unittest.TestCase):
         self.assertTrue(len(response))
 
 
+    def test_validation_errors_message(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": {"phone": "89175002040", "email": "stupnikovotus.ru"}}
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertEqual("attribute phone must starts with 7; attribute email must contains @", response)
+
+
+    @cases([
+        ({"phone": "79175002040", "birthday": "29.02.1940", "gender": 1}, ["Age over 70 years!"]),
+        ({"birthday": " 1.1.2000", "gender": 1}, []),
+        ({"birthday": "1.1.2000 ", "gender": 1},
+         ["Attribute birthday must be str in DD.MM.YYYY format"]),
+    ])
+    def test_request_schema(self, arguments, errors):
+        request = api.OnlineScoreRequest(arguments)
+        self.assertEqual(errors, request.errors)
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual(list(api.OnlineScoreRequest.fields), list(api.OnlineScoreRequest.__slots__))
+
+
+    @cases([
+        ({"account": "horns&hoofs", "login": "h&f", "token": "токен"}, False),
+        ({"account": "horns&hoofs", "login": "h&f", "token": 5}, False),
+        ({"account": "horns&hoofs", "login": "h&f", "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"}, True),
+        ({"account": "horns&hoofs", "login": "admin", "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"}, False),
+    ])
+    def test_check_auth(self, request, result):
+        self.assertEqual(result, api.check_auth(api.MethodRequest(request)))
+        # the second check is answered by the cache
+        self.assertEqual(result, api.check_auth(api.MethodRequest(request)))
+
+    def test_admin_digest(self):
+        token = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode('utf-8')).hexdigest()
+        api.admin_digest_cache = (time.time() + 3600, "digest of the last hour")
+        self.assertFalse(api.check_auth(api.MethodRequest({"login": "admin", "token": token})))
+        # the hour is over
+        api.admin_digest_cache = (time.time() - 1, "digest of the last hour")
+        self.assertTrue(api.check_auth(api.MethodRequest({"login": "admin", "token": token})))
+        self.assertGreater(api.admin_digest_cache[0], time.time())
+
+
+    def test_batch(self):
+        calls = [
+            {"method": "online_score", "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"method": "clients_interests", "arguments": {"client_ids": [1, 2]}},
+            {"method": "online_score", "arguments": {"phone": "89175002040"}},
+            {"method": "clients_interests", "arguments": {"client_ids": [2, 3]}},
+            {"method": "unknown"},
+            "call",
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": {"requests": calls}}
+        calls_of_store = []
+        get_interests_many = self.router["clients_interests"]
+        self.router["clients_interests"] = lambda store, cids: calls_of_store.append(cids) or get_interests_many(store, cids)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([api.OK, api.OK, api.INVALID_REQUEST, api.OK, api.NOT_FOUND, api.NOT_FOUND],
+                         [r["code"] for r in response])
+        self.assertEqual({"score": 3.0}, response[0]["response"])
+        self.assertEqual({"1", "2"}, set(response[1]["response"]))
+        self.assertEqual("attribute phone must starts with 7; At least one pair phone-email, first name-last name, "
+                         "gender-birthday should be filled", response[2]["error"])
+        self.assertEqual({"2", "3"}, set(response[3]["response"]))
+        # interests of all calls are fetched at once
+        self.assertEqual([[1, 2, 2, 3]], calls_of_store)
+        self.assertEqual(len(calls), self.context["ncalls"])
+
+    @cases([
+        ({"requests": []}, api.INVALID_REQUEST),
+        ({"requests": {"method": "online_score"}}, api.INVALID_REQUEST),
+        ({"requests": [{"method": "online_score"}] * (api.MAX_BATCH_SIZE + 1)}, api.INVALID_REQUEST),
+        ({}, api.INVALID_REQUEST),
+    ])
+    def test_invalid_batch(self, arguments, code):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": arguments}
+        self.assertEqual(code, self.get_response(request)[1])
+
+    def test_batch_forbidden(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch", "token": "",
+                   "arguments": {"requests": [{"method": "online_score", "arguments": {}}]}}
+        self.assertEqual(api.FORBIDDEN, self.get_response(request)[1])
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = api.PoolHTTPServer(('127.0.0.1', 0), api.main_http_handler(store.create_store("memory://")),
+                                         workers=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def connect(self):
+        return http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+
+    def post(self, conn, path, request):
+        conn.request('POST', path, json.dumps(request), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_keep_alive(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        conn = self.connect()
+        status, body = self.post(conn, '/online_score/', request)
+        self.assertEqual(api.OK, status)
+        self.assertEqual(api.OK, body["code"])
+        sock = conn.sock
+        status, body = self.post(conn, '/unknown/', request)
+        self.assertEqual(api.NOT_FOUND, status)
+        self.assertIs(sock, conn.sock)
+        conn.close()
+
+    def test_stats(self):
+        conn = self.connect()
+        conn.request('GET', '/stats')
+        response = conn.getresponse()
+        self.assertEqual(api.OK, response.status)
+        self.assertEqual({"hits", "store_hits", "misses", "store_errors", "size"},
+                         set(json.loads(response.read())["response"]["score_cache"]))
+        conn.close()
+
+    def test_slow_client(self):
+        # a connection waiting for the body does not block other clients
+        slow = self.connect()
+        slow.putrequest('POST', '/online_score/')
+        slow.putheader('Content-Length', '100')
+        slow.endheaders()
+        conn = self.connect()
+        status, _ = self.post(conn, '/online_score/', {"arguments": {}})
+        self.assertEqual(api.FORBIDDEN, status)
+        conn.close()
+        slow.send(b"x" * 100)
+        self.assertEqual(api.BAD_REQUEST, slow.getresponse().status)
+        slow.close()
+
+    def test_interests_batch_size(self):
+        kv = FailingStore(store.create_store("memory://"), set())
+        server = api.PoolHTTPServer(('127.0.0.1', 0), api.main_http_handler(kv, interests_batch_size=2), workers=1)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": {"client_ids": [1, 2, 3]}}
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+            status, body = self.post(conn, '/clients_interests/', request)
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(api.OK, status)
+        self.assertEqual([["i:1", "i:2"], ["i:3"]], kv.calls)
+
+
+
+class FailingStore(object):
+    """Store failing multi-gets of keys in failed"""
+
+    def __init__(self, kv, failed):
+        self.kv = kv
+        self.failed = failed
+        self.calls = []
+
+    def get_many(self, keys):
+        self.calls.append(keys)
+        if self.failed.intersection(keys):
+            raise store.StoreError("connection refused")
+        return self.kv.get_many(keys)
+
+
+class TestInterests(unittest.TestCase):
+    def setUp(self):
+        self.kv = store.create_store("memory://")
+        for cid in range(5):
+            self.kv.set("i:%s" % cid, json.dumps(["cars", str(cid)]))
+        self.kv.set("i:5", "{broken")
+        self.router = {"clients_interests": functools.partial(scoring.get_interests_many, batch_size=1)}
+        self.token = "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"
+
+    def test_batches(self):
+        kv = FailingStore(self.kv, set())
+        interests = scoring.get_interests_many(kv, [0, 1, 2, 1, 7], batch_size=2)
+        self.assertEqual({0: ["cars", "0"], 1: ["cars", "1"], 2: ["cars", "2"], 7: []}, interests)
+        self.assertEqual([["i:0", "i:1"], ["i:2", "i:7"]], kv.calls)
+
+    def test_partial_failure(self):
+        kv = FailingStore(self.kv, {"i:2"})
+        interests = scoring.get_interests_many(kv, [0, 1, 2, 3, 5], batch_size=2)
+        self.assertEqual({0: ["cars", "0"], 1: ["cars", "1"], 2: None, 3: None, 5: None}, interests)
+
+    @cases([
+        ([0, 2], {"i:2"}, api.OK, {"0": ["cars", "0"], "2": None}),
+        ([2], {"i:2"}, api.INTERNAL_ERROR, None),
+    ])
+    def test_method_handler(self, client_ids, failed, code, response):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "token": self.token,
+                   "arguments": {"client_ids": client_ids}}
+        context = {}
+        self.assertEqual((response, code),
+                         api.method_handler(request, context, self.router, FailingStore(self.kv, failed)))
+        self.assertEqual([2], context["failed"])
+
+
+class BrokenStore(object):
+    def get(self, key, retries=None):
+        raise store.StoreError("connection refused")
+
+    def set(self, key, value, expire=None, retries=None):
+        raise store.StoreError("connection refused")
+
+
+class SlowStore(object):
+    """Store writing to kv after delay seconds"""
+
+    def __init__(self, kv, delay):
+        self.kv = kv
+        self.delay = delay
+
+    def get(self, key, retries=None):
+        return self.kv.get(key)
+
+    def set(self, key, value, expire=None, retries=None):
+        time.sleep(self.delay)
+        self.kv.set(key, value, expire)
+
+
+class TestScoreCache(unittest.TestCase):
+    def setUp(self):
+        self.computed = []
+
+    def compute(self, request):
+        self.computed.append(request)
+        return scoring.compute_score(request)
+
+    def request(self, phone="79175002040", **arguments):
+        return api.OnlineScoreRequest(dict(arguments, phone=phone, email="stupnikov@otus.ru"))
+
+    def test_lru(self):
+        cache = scoring.ScoreCache(maxsize=2)
+        for phone in ("79175002040", "79175002041", "79175002040", "79175002042", "79175002041"):
+            self.assertEqual(3.0, cache.get(None, self.request(phone), self.compute))
+        self.assertEqual(4, len(self.computed))
+        self.assertEqual({"hits": 1, "store_hits": 0, "misses": 4, "store_errors": 0, "size": 2}, cache.stats())
+
+    def test_ttl(self):
+        cache = scoring.ScoreCache(ttl=0.01)
+        cache.get(None, self.request(), self.compute)
+        time.sleep(0.02)
+        cache.get(None, self.request(), self.compute)
+        self.assertEqual(2, len(self.computed))
+
+    def test_key(self):
+        self.assertEqual(scoring.ScoreCache.key(self.request(birthday="01.01.2000", gender=1)),
+                         scoring.ScoreCache.key(self.request(birthday="1.1.2000", gender=1)))
+        self.assertNotEqual(scoring.ScoreCache.key(self.request(gender=1)),
+                            scoring.ScoreCache.key(self.request(gender=2)))
+
+    def test_shared(self):
+        kv = store.create_store("memory://")
+        writer = scoring.ScoreCache(shared=True)
+        writer.get(kv, self.request(), self.compute)
+        writer.flush()
+        cache = scoring.ScoreCache(shared=True)
+        self.assertEqual(3.0, cache.get(kv, self.request(), self.compute))
+        self.assertEqual(1, len(self.computed))
+        self.assertEqual(1, cache.stats()["store_hits"])
+
+    def test_store_failure(self):
+        cache = scoring.ScoreCache(shared=True)
+        self.assertEqual(3.0, cache.get(BrokenStore(), self.request(), self.compute))
+        self.assertEqual(1, cache.stats()["store_errors"])
+        self.assertEqual(1, cache.stats()["misses"])
+
+    def test_store_skipped_after_failure(self):
+        kv = BrokenStore()
+        cache = scoring.ScoreCache(maxsize=0, shared=True, break_time=0.05)
+        for _ in range(3):
+            self.assertEqual(3.0, cache.get(kv, self.request(), self.compute))
+        self.assertEqual(1, cache.stats()["store_errors"])
+        time.sleep(0.06)
+        cache.get(kv, self.request(), self.compute)
+        self.assertEqual(2, cache.stats()["store_errors"])
+
+    def test_write_back_does_not_wait(self):
+        slow = SlowStore(store.create_store("memory://"), 0.2)
+        cache = scoring.ScoreCache(shared=True, store=slow)
+        start = time.monotonic()
+        self.assertEqual(3.0, cache.get(None, self.request(), self.compute))
+        self.assertLess(time.monotonic() - start, 0.1)
+        cache.flush()
+        self.assertEqual("3.0", slow.kv.get(scoring.ScoreCache.key(self.request())))
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'api.log')
+        self.logger = logging.getLogger('test_api')
+        self.logger.propagate = False
+
+    def tearDown(self):
+        for handler in self.logger.handlers:
+            handler.close()
+        self.logger.handlers.clear()
+        self.dir.cleanup()
+
+    def records(self, sample_rate):
+        listener = api.setup_logging(self.path, sample_rate, self.logger)
+        context = {"request_id": "1", "has": ["phone"]}
+        self.logger.info("%s: %s", "/online_score/", b"{}", extra={"request_id": "1"})
+        self.logger.info("response", extra={"request_id": "1", "context": context})
+        self.logger.error("Validation Error: attribute phone must starts with 7;")
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception("failed")
+        listener.stop()
+        self.assertTrue(all(handler.stream is None for handler in listener.handlers))
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_json(self):
+        records = self.records(1.0)
+        self.assertEqual(["/online_score/: b'{}'", "response", "Validation Error: attribute phone must starts with 7;",
+                          "failed"], [r["message"] for r in records])
+        self.assertEqual({"request_id": "1", "has": ["phone"]}, records[1]["context"])
+        self.assertEqual(["INFO", "INFO", "ERROR", "ERROR"], [r["level"] for r in records])
+        self.assertIn("ZeroDivisionError", records[3]["exc"])
+
+    def test_sampling(self):
+        self.assertEqual(["ERROR", "ERROR"], [r["level"] for r in self.records(0.0)])
+
+
+class RedisStandIn(socketserver.StreamRequestHandler):
+    """Serves GET, SET and MGET of Redis protocol from MemoryStorage of the server"""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2].decode('utf-8'))
+        return args
+
+    def bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        value = value.encode('utf-8')
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        storage = self.server.storage
+        while True:
+            args = self.read_command()
+            if args is None:
+                break
+            command = args[0].upper()
+            if command == 'GET':
+                self.wfile.write(self.bulk(storage.get(args[1])))
+            elif command == 'MGET':
+                values = storage.mget(args[1:])
+                self.wfile.write(b'*%d\r\n' % len(values) + b''.join(self.bulk(v) for v in values))
+            elif command == 'SET':
+                storage.set(args[1], args[2], int(args[4]) if len(args) > 4 else None)
+                self.wfile.write(b'+OK\r\n')
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
+class GarbageStandIn(socketserver.StreamRequestHandler):
+    """Answers every command with a malformed reply"""
+
+    def handle(self):
+        while self.rfile.readline():
+            self.wfile.write(self.server.reply)
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'store.sock')
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, RedisStandIn)
+        self.server.daemon_threads = True
+        self.server.storage = store.MemoryStorage()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.dir.cleanup()
+
+    def test_unix_socket(self):
+        kv = store.create_store("unix://" + self.path, pool_size=2)
+        kv.set("i:1", json.dumps(["cars", "pets"]))
+        self.assertEqual(["cars", "pets"], scoring.get_interests(kv, 1))
+        self.assertEqual([], scoring.get_interests(kv, 2))
+        self.assertEqual({1: ["cars", "pets"], 2: []}, scoring.get_interests_many(kv, [1, 2]))
+        with self.assertRaises(store.ResponseError):
+            kv.call("execute", ("INCR", "i:1"))
+        self.assertEqual(1, kv.pool.idle.qsize())
+        kv.close()
+
+    def test_reconnect(self):
+        kv = store.create_store("unix://" + self.path, retry_delay=0)
+        kv.set("key", "value")
+        # the server drops the connection, the next call reconnects
+        connection = kv.pool.idle.get_nowait()
+        connection.sock.shutdown(2)
+        kv.pool.idle.put(connection)
+        self.assertEqual("value", kv.get("key"))
+        kv.close()
+
+    def test_timeout_not_retried(self):
+        path = os.path.join(self.dir.name, 'silent.sock')
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        silent.bind(path)
+        silent.listen(8)
+        attempts = []
+
+        def connect(timeout):
+            attempts.append(timeout)
+            return store.RedisConnection(path, timeout)
+
+        kv = store.Store(connect, timeout=0.2, retries=3, retry_delay=0)
+        start = time.monotonic()
+        with self.assertRaises(store.StoreError):
+            kv.get_many(["i:1", "i:2"])
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual([0.2], attempts)
+        kv.close()
+        silent.close()
+
+    def test_score_cache_of_silent_store(self):
+        path = os.path.join(self.dir.name, 'silent.sock')
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        silent.bind(path)
+        silent.listen(8)
+        kv = store.create_store("unix://" + path, timeout=scoring.SCORE_CACHE_TIMEOUT, retries=0)
+        cache = scoring.ScoreCache(maxsize=0, shared=True, store=kv)
+        request = api.OnlineScoreRequest({"phone": "79175002040", "email": "stupnikov@otus.ru"})
+        start = time.monotonic()
+        for _ in range(5):
+            self.assertEqual(3.0, cache.get(None, request, scoring.compute_score))
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(1, cache.stats()["store_errors"])
+        kv.close()
+        silent.close()
+
+    def test_malformed_reply(self):
+        path = os.path.join(self.dir.name, 'garbage.sock')
+        server = socketserver.ThreadingUnixStreamServer(path, GarbageStandIn)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            kv = store.create_store("unix://" + path, retry_delay=0)
+            server.reply = b'*2\r\n$x\r\n'
+            self.assertEqual({1: None, 2: None}, scoring.get_interests_many(kv, [1, 2]))
+            server.reply = b'$2\r\n\xff\xfe\r\n'
+            with self.assertRaises(store.StoreError):
+                kv.get("key")
+            self.assertEqual(0, kv.pool.idle.qsize())
+            kv.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_retries_exhausted(self):
+        attempts = []
+
+        def connect(timeout):
+            attempts.append(timeout)
+            raise ConnectionRefusedError()
+
+        kv = store.Store(connect, timeout=0.5, retries=2, retry_delay=0)
+        with self.assertRaises(store.StoreError):
+            kv.get("key")
+        self.assertEqual([0.5] * 3, attempts)
+
+    def test_memory_expire(self):
+        kv = store.create_store("memory://")
+        kv.set("key", 1, expire=0.01)
+        self.assertEqual("1", kv.get("key"))
+        time.sleep(0.02)
+        self.assertIsNone(kv.get("key"))
+
+
 if __name__ == "__main__":
     unittest.main()